@@ -0,0 +1,186 @@
+"""
+Benchmark of the activity stream builder (ckanext.tracker.stream) using synthetic TaskStatus objects. It also runs the
+previous (quadratic, dense) implementation up to LEGACY_LIMIT activities and checks both result in the same table, by
+laying out the cells of both the way `tracker/snippets/job_stream.html` renders them.
+
+    python bin/benchmark_stream.py [n_activities ...]
+"""
+import hashlib
+import math
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ckanext', 'tracker'))
+from stream import build_stream  # noqa: E402 (ckanext.tracker itself needs CKAN)
+
+LEGACY_LIMIT = 10000
+
+
+class Activity(object):
+    """
+    Just enough of DomainTaskStatus for the stream
+    """
+
+    def __init__(self, id, action, created, duration, finished=True):
+        self.id = id
+        self.action = action
+        self.created = created
+        self.pending = created + timedelta(seconds=1)
+        self.running = created + timedelta(seconds=2)
+        self.complete = created + timedelta(seconds=duration) if finished else None
+
+    def get_state(self, timestamp):
+        if self.complete is not None and timestamp >= self.complete:
+            return 'complete'
+        if timestamp >= self.running:
+            return 'running'
+        if timestamp >= self.pending:
+            return 'pending'
+        return 'created'
+
+    def hash(self):
+        return hashlib.md5(self.id.encode('utf-8')).hexdigest()
+
+
+def create_activities(n, trackers=6, seed=42):
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    activities = {}
+    for i in range(n):
+        created = start + timedelta(seconds=rng.randint(0, n * 30))
+        activity = Activity('task-{}'.format(i), 'update_package', created, rng.randint(3, 600), rng.random() > 0.01)
+        activities.setdefault('tracker_{}'.format(i % trackers), []).append(activity)
+    for stream in activities.values():
+        stream.sort(key=lambda activity: activity.created)
+    return activities
+
+
+def legacy_build_stream(activities):
+    """
+    The implementation get_tracker_activities_stream used before (python 3 compatible)
+    """
+    timestamps = []
+    tracker_streams = {}
+    rows = []
+    for name, stream in activities.items():
+        for activity in stream:
+            timestamps.extend(filter(None, [activity.created, activity.pending, activity.running, activity.complete]))
+    timestamps = sorted(list(set(timestamps)))
+    for name, tracker_activities in activities.items():
+        streams = []
+        max_timestamps = []
+        for activity in tracker_activities:
+            saved_to_stream = False
+            for i in range(len(streams)):
+                if max_timestamps[i] >= activity.created:
+                    continue
+                streams[i].append(activity)
+                max_timestamps[i] = datetime.max if activity.complete is None else activity.complete
+                saved_to_stream = True
+                break
+            if not saved_to_stream:
+                streams.append([activity])
+                max_timestamps.append(datetime.max if activity.complete is None else activity.complete)
+        for s in range(len(streams)):
+            timestamp_stream = [None] * len(timestamps)
+            for activity in streams[s]:
+                end = len(timestamps) - 1
+                start = timestamps.index(activity.created)
+                if activity.complete is not None:
+                    end = timestamps.index(activity.complete)
+                t_list = [None] * (end + 1 - start)
+                for t in range(start, end + 1):
+                    t_list[t - start] = {
+                        "state": activity.get_state(timestamps[t]),
+                        "id": activity.id,
+                        "hash": activity.hash(),
+                        "action": activity.action,
+                        "start": t == start,
+                        "end": t == end
+                    }
+                timestamp_stream[start:end + 1] = t_list
+            streams[s] = timestamp_stream
+        tracker_streams[name] = streams
+    for t in range(len(timestamps)):
+        diff = 0
+        if t + 1 < len(timestamps):
+            diff = math.log10((timestamps[t + 1] - timestamps[t]).total_seconds())
+        _t = {"timestamp": timestamps[t], "diff": int(diff) if diff > 0 else 0, "activities": []}
+        for name, streams in tracker_streams.items():
+            for stream in streams:
+                _t["activities"].append(stream[t])
+        rows.append(_t)
+    headers = [{"name": name, "size": len(streams)} for name, streams in tracker_streams.items()]
+    return headers, reversed(rows)
+
+
+def run(build, activities):
+    headers, rows = build(activities)
+    return headers, list(rows)
+
+
+def _visual(activity, spacer=False):
+    """
+    What a cell looks like: cells between the start and end of an activity only show its state
+    """
+    if activity is None or (spacer and activity["end"]):
+        return None
+    if spacer:
+        return activity["state"], False, False, None
+    details = (activity["id"], activity["action"], activity["hash"]) if activity["start"] else None
+    return activity["state"], activity["start"], activity["end"], details
+
+
+def legacy_layout(rows):
+    layout = []
+    for row in rows:
+        if row["diff"] > 0:
+            layout.append((None, row["diff"], [_visual(activity, spacer=True) for activity in row["activities"]]))
+        layout.append((row["timestamp"], row["diff"], [_visual(activity) for activity in row["activities"]]))
+    return layout
+
+
+def layout(headers, rows):
+    """
+    Expands the sparse rows (cells spanning several rows) into every cell of the table
+    """
+    n_col = sum(header["size"] for header in headers)
+    remaining = [0] * n_col
+    current = [None] * n_col
+    result = []
+    for row in rows:
+        cells = iter(row["cells"])
+        for column in range(n_col):
+            if remaining[column] == 0:
+                cell = next(cells)
+                remaining[column], current[column] = cell["rows"], _visual(cell["activity"])
+            remaining[column] -= 1
+        if next(cells, None) is not None:
+            raise AssertionError('too many cells on the row of {}'.format(row["timestamp"]))
+        result.append((row["timestamp"], row["diff"], list(current)))
+    if any(remaining):
+        raise AssertionError('cells span beyond the last row')
+    return result
+
+
+def main(sizes):
+    print('{:>8} {:>12} {:>12}'.format('n', 'stream (s)', 'legacy (s)'))
+    for n in sizes:
+        activities = create_activities(n)
+        duration = timeit.timeit(lambda: run(build_stream, activities), number=1)
+        legacy_duration = None
+        if n <= LEGACY_LIMIT:
+            legacy_duration = timeit.timeit(lambda: run(legacy_build_stream, activities), number=1)
+            headers, rows = run(build_stream, activities)
+            legacy_headers, legacy_rows = run(legacy_build_stream, activities)
+            if headers != legacy_headers or layout(headers, rows) != legacy_layout(legacy_rows):
+                raise AssertionError('the streams for n={} differ'.format(n))
+        print('{:>8} {:>12.3f} {:>12}'.format(
+            n, duration, '{:.3f}'.format(legacy_duration) if legacy_duration is not None else '-'))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 2000, 10000])
@@ -0,0 +1,131 @@
+import logging
+
+import click
+from ckan import model
+from ckan.model import task_status_table
+from ckan.plugins import toolkit
+from domain.task_status import ERROR, COMPLETE
+from sqlalchemy import and_, func, select
+
+from ckanext.tracker_base.backend import TrackerBackend
+from ckanext.tracker_base import coalesce, job_table
+from ckanext.tracker_base.job_table import tracker_job_table
+import ckanext.tracker_base.helpers as base_helpers
+
+log = logging.getLogger(__name__)
+
+# suits the queries of the helpers and actions, which all filter on entity_id, entity_type and task_type and order by
+# last_updated
+TASK_STATUS_INDEX = 'idx_task_status_tracker'
+TASK_STATUS_INDEX_SQL = 'CREATE INDEX {concurrently} IF NOT EXISTS {name} ' \
+                        'ON task_status (entity_id, entity_type, task_type, last_updated DESC)'
+
+PRUNE_BATCH_SIZE = 10000
+COPY_BATCH_SIZE = 1000
+
+
+@click.group(short_help=u"Tracker commands")
+def tracker():
+    pass
+
+
+@tracker.command(u'init-db', short_help=u"Create the indexes and tables used by the trackers")
+@click.option(u'--concurrently/--no-concurrently', default=True,
+              help=u"Create the indexes without locking the table for writes (default)")
+def init_db(concurrently):
+    """
+    Creates the indexes on the task_status table and the tracker_job table used by the trackers (when they don't
+    exist yet)
+    """
+    sql = TASK_STATUS_INDEX_SQL.format(concurrently='CONCURRENTLY' if concurrently else '', name=TASK_STATUS_INDEX)
+    # CREATE INDEX CONCURRENTLY can't be run inside a transaction
+    with model.meta.engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(sql)
+    click.secho(u"Index {} is present".format(TASK_STATUS_INDEX), fg=u'green')
+    job_table.create_table()
+    click.secho(u"Table {} is present".format(tracker_job_table.name), fg=u'green')
+
+
+@tracker.command(u'prune', short_help=u"Remove old finished jobs of the trackers")
+@click.option(u'--keep', type=int, default=None,
+              help=u"Number of finished jobs to keep per entity and tracker (default: ckanext.tracker.retention.keep)")
+@click.option(u'--dry-run', is_flag=True, help=u"Only count the jobs which would be removed")
+def prune(keep, dry_run):
+    """
+    Removes all but the latest finished (complete or error) jobs (TaskStatus objects) per entity and tracker, the
+    unfinished jobs are always kept
+    """
+    if keep is None:
+        keep = int(toolkit.config.get('ckanext.tracker.retention.keep', 10))
+    tracker_names = [tracker_model.name for tracker_model in TrackerBackend.get_trackers()]
+    if not tracker_names:
+        click.secho(u"No trackers are registered", fg=u'yellow')
+        return
+    tables = [(task_status_table, [task_status_table.c.key != task_status_table.c.task_type])]
+    if job_table.is_written():
+        tables.append((tracker_job_table, []))
+    for table, conditions in tables:
+        count = _prune(table, conditions, tracker_names, keep, dry_run)
+        click.secho(u"{}: {} job(s) {}".format(table.name, count, u'would be removed' if dry_run else u'removed'),
+                    fg=u'green')
+
+
+def _prune(table, conditions, tracker_names, keep, dry_run):
+    ranked = select([
+        table.c.id,
+        func.row_number().over(
+            partition_by=[table.c.entity_id, table.c.entity_type, table.c.task_type],
+            order_by=table.c.last_updated.desc()
+        ).label('row_number')
+    ]).where(
+        and_(
+            table.c.task_type.in_(tracker_names),
+            table.c.state.in_([ERROR, COMPLETE, coalesce.SUPERSEDED]),
+            *conditions
+        )
+    ).alias('ranked')
+    obsolete = select([ranked.c.id]).where(ranked.c.row_number > keep)
+
+    if dry_run:
+        return model.Session.execute(select([func.count()]).select_from(obsolete.alias('obsolete'))).scalar()
+    # the (windowed) query is only run once, the jobs are then removed in batches to keep the transactions (and locks)
+    # short
+    obsolete_ids = [row[0] for row in model.Session.execute(obsolete).fetchall()]
+    model.Session.commit()
+    total = 0
+    for start in range(0, len(obsolete_ids), PRUNE_BATCH_SIZE):
+        result = model.Session.execute(
+            table.delete().where(table.c.id.in_(obsolete_ids[start:start + PRUNE_BATCH_SIZE]))
+        )
+        model.Session.commit()
+        total += result.rowcount
+    return total
+
+
+@tracker.command(u'copy-jobs', short_help=u"Copy the existing jobs into the tracker_job table")
+def copy_jobs():
+    """
+    Copies the jobs (TaskStatus objects) of the trackers which are not in the tracker_job table yet, to be used before
+    switching `ckanext.tracker.job_table` to `on`
+    """
+    tracker_names = [tracker_model.name for tracker_model in TrackerBackend.get_trackers()]
+    query = select([task_status_table]).where(
+        and_(
+            task_status_table.c.task_type.in_(tracker_names),
+            task_status_table.c.key != task_status_table.c.task_type,
+            task_status_table.c.id.notin_(select([tracker_job_table.c.id]))
+        )
+    ).order_by(task_status_table.c.id)
+    total = 0
+    while True:
+        rows = model.Session.execute(query.limit(COPY_BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        job_table.insert_jobs(model.Session, [base_helpers.task_from_row(row) for row in rows])
+        model.Session.commit()
+        total += len(rows)
+    click.secho(u"{} job(s) copied".format(total), fg=u'green')
+
+
+def get_commands():
+    return [tracker]
@@ -1,19 +1,34 @@
 import hashlib
 import json
 import logging
-import math
 from domain import Configuration
+from markupsafe import Markup
 from redis import Redis
 from rq import Queue, Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.registry import StartedJobRegistry, FailedJobRegistry
 from ckan import model
-from datetime import datetime
+from ckan.model import task_status_table
 import ckan.plugins.toolkit as toolkit
 from ckanext.tracker_base.backend import TrackerBackend
+from ckanext.tracker.stream import build_stream
+from ckanext.tracker_base import coalesce, job_table, stats
+from ckanext.tracker_base.cache import TTLCache
+import ckanext.tracker_base.helpers as base_helpers
 from domain.task_status import DomainTaskStatus, ERROR, COMPLETE
-from sqlalchemy import and_
+from sqlalchemy import and_, or_, func, select
 
 log = logging.getLogger(__name__)
 
+BADGE_MODE_INLINE = 'inline'
+BADGE_MODE_URL = 'url'
+
+# the states a badge can be requested for (see the `tracker.badge` endpoint)
+BADGE_STATES = ['created', 'pending', 'running', COMPLETE, ERROR]
+
+BADGE_CACHE = TTLCache('tracker_badges', maxsize=256)
+
 
 def get_tracker_activities(entity_type, entity_id, limit=100):
     trackers = []
@@ -22,18 +37,21 @@ def get_tracker_activities(entity_type, entity_id, limit=100):
         if tracker.show_ui:
             trackers.append(tracker.name)
     query = []
-    if trackers:
-        query = model.Session.query(model.TaskStatus) \
-            .filter(and_(
-            model.TaskStatus.entity_id == entity_id,
-            model.TaskStatus.entity_type == entity_type,
-            model.TaskStatus.task_type.in_(trackers),
-            model.TaskStatus.key != model.TaskStatus.task_type,
-        )).order_by(model.TaskStatus.last_updated.desc()).limit(limit).all()
-    task_status_list = sorted(
-        [DomainTaskStatus.from_dict(task_status.as_dict()) for task_status in query],
-        key=lambda x: x.created
-    )
+    if trackers and job_table.is_read():
+        task_status_list = job_table.select_jobs(entity_type, entity_id, trackers, limit)
+    else:
+        if trackers:
+            query = model.Session.query(model.TaskStatus) \
+                .filter(and_(
+                model.TaskStatus.entity_id == entity_id,
+                model.TaskStatus.entity_type == entity_type,
+                model.TaskStatus.task_type.in_(trackers),
+                model.TaskStatus.key != model.TaskStatus.task_type,
+            )).order_by(model.TaskStatus.last_updated.desc()).limit(limit).all()
+        task_status_list = sorted(
+            [DomainTaskStatus.from_dict(task_status.as_dict()) for task_status in query],
+            key=lambda x: x.created
+        )
     for task_status in task_status_list:
         if task_status.task_type in result:
             result[task_status.task_type].append(task_status)
@@ -42,81 +60,15 @@ def get_tracker_activities(entity_type, entity_id, limit=100):
     return result
 
 
-def get_tracker_activities_stream(entity_type, entity_id, limit=100):
-    activities = get_tracker_activities(entity_type, entity_id, limit)
-    timestamps = []
-    tracker_streams = {}
-    rows = []
-    ## create timestamps
-    for name, stream in activities.iteritems():
-        for activity in stream:
-            timestamps.extend(filter(None, [activity.created, activity.pending, activity.running, activity.complete]))
-    timestamps = sorted(list(set(timestamps)))
-    for name, tracker_activities in activities.iteritems():
-        streams = []
-        max_timestamps = []
-        for activity in tracker_activities:
-            saved_to_stream = False
-            n_streams = len(streams)
-            for i in range(n_streams):
-                if max_timestamps[i] >= activity.created:
-                    continue
-                else:
-                    streams[i].append(activity)
-                    if activity.complete is None:
-                        max_timestamps[i] = datetime.max
-                    else:
-                        max_timestamps[i] = activity.complete
-                    saved_to_stream = True
-                    break
-            if not saved_to_stream:
-                streams.append([activity])
-                if activity.complete is None:
-                    max_timestamps.append(datetime.max)
-                else:
-                    max_timestamps.append(activity.complete)
-        for s in range(len(streams)):
-            timestamp_stream = [None] * len(timestamps)
-            for activity in streams[s]:
-                end = len(timestamps) - 1
-                start = timestamps.index(activity.created)
-                if activity.complete is not None:
-                    end = timestamps.index(activity.complete)
-                t_list = [None] * (end + 1 - start)
-                for t in range(start, end + 1):
-                    t_list[t - start] = {
-                        "state": activity.get_state(timestamps[t]),
-                        "id": activity.id,
-                        "hash": activity.hash(),
-                        "action": activity.action,
-                        "start": t == start,
-                        "end": t == end
-                    }
-                timestamp_stream[start:end + 1] = t_list
-            streams[s] = timestamp_stream
-        tracker_streams[name] = streams
-    for t in range(len(timestamps)):
-        diff = None
-        if t + 1 < len(timestamps):
-            diff = math.log10((timestamps[t+1] - timestamps[t]).total_seconds())
-        _t = {
-            "timestamp": timestamps[t],
-            "diff": int(diff) if diff > 0 else 0,
-            "activities": []
-        }
-        for name, streams in tracker_streams.iteritems():
-            for stream in streams:
-                _t["activities"].append(stream[t])
-        rows.append(_t)
-
-    headers = []
-    for name, streams in tracker_streams.iteritems():
-        headers.append({
-            "name": name,
-            "size": len(streams)
-        })
-
-    return headers, reversed(rows)
+def get_tracker_activities_stream(entity_type, entity_id, limit=None):
+    """
+    This method will return the headers and rows (newest first) of the activity stream of an entity, see
+    `ckanext.tracker.stream.build_stream`. The complete history can be retrieved page by page using the
+    `tracker_activity_list` action
+    """
+    if limit is None:
+        limit = int(toolkit.config.get('ckanext.tracker.stream_limit', 100))
+    return build_stream(get_tracker_activities(entity_type, entity_id, limit))
 
 
 WORKER_STATUS_MAPPING = {
@@ -141,7 +93,7 @@ JOB_STATUS_MAPPING = {
 # queued, started, deferred, finished, stopped, scheduled, canceled and failed
 
 
-def get_tracker_queues():
+def _get_queues_skeleton():
     result = {}
     trackers = TrackerBackend.get_trackers()
     for tracker in trackers:
@@ -154,38 +106,45 @@ def get_tracker_queues():
             }
         result[queue]['n_plugins'] += 1
         result[queue]['plugins'][tracker.name] = {'n_jobs': 0, 'jobs': {'queued': 0, 'running': 0, 'failed': 0}}
+    return result
 
+
+def _get_redis():
     redis_url = toolkit.config.get('ckan.redis.url', "redis://localhost:6379/")
-    site_url = toolkit.config.get('ckan.site_url')
-    redis = Redis.from_url(redis_url)
+    return Redis.from_url(redis_url)
+
+
+def _get_job_source_and_plugin(job):
+    """
+    Returns the source CKAN and the plugin which created a job, based on its configuration (or envelope)
+    """
+    configuration = job.args[0]
+    if isinstance(configuration, dict) and 'plugin' in configuration:
+        # compact payload (see ckanext.tracker_base.envelope)
+        return configuration['source'], configuration['plugin']
+    if not isinstance(configuration, Configuration):
+        configuration = Configuration.from_dict(json.loads(configuration))
+    return configuration.source_ckan_host, configuration.plugin_name
+
+
+def get_tracker_queues():
+    """
+    Returns the number of jobs per queue, plugin and status (based on the counters kept by the trackers, see
+    `ckanext.tracker_base.stats`) and the number of workers per queue and status
+    """
+    result = _get_queues_skeleton()
+    redis = _get_redis()
+    counters = stats.read(redis, list(result.keys()))
     for queue in result:
-        redis_queue = Queue(connection=redis, name=queue)
-        # result[queue]['jobs'] = len(redis_queue.jobs)
-        for job in redis_queue.jobs:
-            configuration = job.args[0]
-            if not isinstance(configuration, Configuration):
-                configuration = Configuration.from_dict(json.loads(configuration))
-            if configuration.source_ckan_host == site_url:
-                plugin_name = configuration.plugin_name
-                if plugin_name in result[queue]['plugins']:
-                    result[queue]['plugins'][plugin_name]['n_jobs'] += 1
-                    result[queue]['n_jobs'] += 1
-                    job_status = job.get_status()
-                    if job_status in JOB_STATUS_MAPPING:
-                        result[queue]['jobs'][JOB_STATUS_MAPPING[job_status]] += 1
-                        result[queue]['plugins'][plugin_name]['jobs'][JOB_STATUS_MAPPING[job_status]] += 1
-                    else:
-                        log.debug("job status '{}' not found in mapping".format(job_status))
-    failed_queue = Queue(connection=redis, name='failed')
-    for failed_job in failed_queue.jobs:
-        queue = failed_job.origin
-        if queue in result:
-            result[queue]['n_jobs'] += 1
-            job_status = failed_job.get_status()
-            if job_status in JOB_STATUS_MAPPING:
-                result[queue]['jobs'][JOB_STATUS_MAPPING[job_status]] += 1
-            else:
-                log.debug("job status '{}' not found in mapping".format(job_status))
+        for plugin_name, statuses in counters.get(queue, {}).items():
+            if plugin_name not in result[queue]['plugins']:
+                continue
+            for status in stats.STATUSES:
+                count = statuses.get(status, 0)
+                result[queue]['plugins'][plugin_name]['jobs'][status] += count
+                result[queue]['plugins'][plugin_name]['n_jobs'] += count
+                result[queue]['jobs'][status] += count
+                result[queue]['n_jobs'] += count
     workers = Worker.all(redis)
     for worker in workers:
         for queue in worker.queues:
@@ -199,6 +158,109 @@ def get_tracker_queues():
     return result
 
 
+def reconcile_tracker_queues():
+    """
+    Counts the jobs per queue, plugin and status by going through all jobs (queued, running and failed) and replaces
+    the counters with the result. This loads every job so it can take a long time when a lot of jobs are queued
+    """
+    site_url = toolkit.config.get('ckan.site_url')
+    redis = _get_redis()
+    result = {}
+    for queue, value in _get_queues_skeleton().items():
+        counters = {plugin_name: {'queued': 0, 'running': 0, 'failed': 0} for plugin_name in value['plugins']}
+        redis_queue = Queue(connection=redis, name=queue)
+        jobs = [('queued', job) for job in redis_queue.jobs]
+        for status, registry in [('running', StartedJobRegistry(queue=redis_queue)),
+                                 ('failed', FailedJobRegistry(queue=redis_queue))]:
+            for job_id in registry.get_job_ids():
+                try:
+                    jobs.append((status, Job.fetch(job_id, connection=redis)))
+                except NoSuchJobError:
+                    log.debug("job {} not found".format(job_id))
+        for status, job in jobs:
+            try:
+                source_ckan_host, plugin_name = _get_job_source_and_plugin(job)
+            except Exception as unexpected_error:
+                log.debug("could not determine the plugin of job {}: {}".format(job.id, unexpected_error))
+                continue
+            if source_ckan_host == site_url and plugin_name in counters:
+                counters[plugin_name][status] += 1
+        stats.replace(redis, queue, counters)
+        result[queue] = counters
+    return result
+
+
+def _get_request_cache():
+    """
+    Returns a dict which lives as long as the current request (a new one when there is no request)
+    """
+    try:
+        cache = getattr(toolkit.g, 'tracker_task_statuses', None)
+        if cache is None:
+            cache = {}
+            toolkit.g.tracker_task_statuses = cache
+        return cache
+    except (RuntimeError, TypeError, AttributeError):
+        return {}
+
+
+def get_latest_task_statuses(entity_type, entity_ids):
+    """
+    This method will return the relevant TaskStatus objects of all trackers for the given entities using a single query:
+    all unfinished ones or, when a tracker has none for an entity, its last finished one. The result is kept for the
+    rest of the request, so the badges and status panels of the same entity don't query the TaskStatus table again
+    @param entity_type: type of tracker ('resource', 'package', etc)
+    @param entity_ids: the ids of the entities (resource ids, package ids, etc)
+    @return: dict containing per entity_id a dict with per tracker name the list of TaskStatus objects (newest first)
+    """
+    cache = _get_request_cache()
+    missing = [entity_id for entity_id in set(entity_id for entity_id in entity_ids if entity_id)
+               if (entity_type, entity_id) not in cache]
+    if missing:
+        for entity_id in missing:
+            cache[(entity_type, entity_id)] = {}
+        tracker_names = [tracker.name for tracker in TrackerBackend.get_trackers()]
+        if tracker_names and job_table.is_read():
+            tasks = {}
+            for job in job_table.select_latest(entity_type, missing, tracker_names):
+                tasks.setdefault((job.entity_id, job.task_type), []).append(job)
+            for (entity_id, task_type), task_list in tasks.items():
+                unfinished = [task for task in task_list if task.state not in [ERROR, COMPLETE]]
+                cache[(entity_type, entity_id)][task_type] = unfinished or task_list[:1]
+        elif tracker_names:
+            task_status = task_status_table
+            finished = task_status.c.state.in_([ERROR, COMPLETE])
+            ranked = select(list(task_status.c) + [
+                func.row_number().over(
+                    partition_by=[task_status.c.entity_id, task_status.c.task_type, finished],
+                    order_by=task_status.c.last_updated.desc()
+                ).label('row_number')
+            ]).where(
+                and_(
+                    task_status.c.entity_id.in_(missing),
+                    task_status.c.entity_type == entity_type,
+                    task_status.c.task_type.in_(tracker_names),
+                    task_status.c.key != task_status.c.task_type,
+                    task_status.c.state != coalesce.SUPERSEDED
+                )
+            ).alias('ranked')
+            rows = model.Session.execute(
+                select([column for column in ranked.c if column.name != 'row_number']).where(
+                    or_(
+                        ranked.c.state.notin_([ERROR, COMPLETE]),
+                        ranked.c.row_number == 1
+                    )
+                ).order_by(ranked.c.last_updated.desc())
+            ).fetchall()
+            tasks = {}
+            for row in rows:
+                tasks.setdefault((row['entity_id'], row['task_type']), []).append(base_helpers.task_from_row(row))
+            for (entity_id, task_type), task_list in tasks.items():
+                unfinished = [task for task in task_list if task.state not in [ERROR, COMPLETE]]
+                cache[(entity_type, entity_id)][task_type] = unfinished or task_list[:1]
+    return {entity_id: cache.get((entity_type, entity_id), {}) for entity_id in entity_ids if entity_id}
+
+
 def get_tracker_status(context, tracker, entity_type, entity_id):
     """
     This method will return the TaskStatus information for a specific tracker and entity_id
@@ -209,39 +271,7 @@ def get_tracker_status(context, tracker, entity_type, entity_id):
     """
     if not entity_id:
         return None
-    query = model.Session.query(
-        model.TaskStatus
-    ).filter(
-        and_(
-            model.TaskStatus.entity_id == entity_id,
-            model.TaskStatus.entity_type == entity_type,
-            model.TaskStatus.task_type == tracker.name,
-            model.TaskStatus.key != model.TaskStatus.task_type,
-            model.TaskStatus.state.notin_([ERROR, COMPLETE])
-        )
-    ).order_by(
-        model.TaskStatus.last_updated.desc()
-    ).all()
-    result = None
-    if query is None or len(query) == 0:
-        query = model.Session.query(
-            model.TaskStatus
-        ).filter(
-            and_(
-                model.TaskStatus.entity_id == entity_id,
-                model.TaskStatus.entity_type == entity_type,
-                model.TaskStatus.task_type == tracker.name,
-                model.TaskStatus.key != model.TaskStatus.task_type,
-                model.TaskStatus.state.in_([ERROR, COMPLETE])
-            )
-        ).order_by(
-            model.TaskStatus.last_updated.desc()
-        ).first()
-        if query is not None:
-            query = [query]
-    if query is not None and len(query) > 0:
-        result = [DomainTaskStatus.from_dict(row.as_dict()) for row in query]
-    return result
+    return get_latest_task_statuses(entity_type, [entity_id])[entity_id].get(tracker.name)
 
 
 def get_tracker_statuses(entity_type, entity_id):
@@ -252,13 +282,13 @@ def get_tracker_statuses(entity_type, entity_id):
     @param entity_id: the id of an entity (resource id, package id, etc)
     @return: list of dicts containing the information of the TaskStatus objects
     """
-    context = {'user': toolkit.g.user}
     result = {}
+    if not entity_id:
+        return result
+    statuses = get_latest_task_statuses(entity_type, [entity_id])[entity_id]
     for tracker in TrackerBackend.get_trackers():
-        if tracker.show_ui:
-            status = get_tracker_status(context, tracker, entity_type, entity_id)
-            if status is not None:
-                result[tracker.name] = status
+        if tracker.show_ui and tracker.name in statuses:
+            result[tracker.name] = statuses[tracker.name]
     return result
 
 
@@ -270,13 +300,28 @@ def get_tracker_badges(entity_type, entity_id):
     @param entity_id: the id of an entity (resource id, package id, etc)
     @return: list of strings containing the badges
     """
-    context = {'user': toolkit.g.user}
+    if not entity_id:
+        return {}
+    return get_tracker_badges_bulk(entity_type, [entity_id])[entity_id]
+
+
+def get_tracker_badges_bulk(entity_type, entity_ids):
+    """
+    This method will get the badges (see `get_tracker_badges`) for a list of entities using a single query, also
+    making sure any later `get_tracker_badges` for one of these entities during the same request needs no query at all
+    @param entity_type: type of tracker ('resource', 'package', etc)
+    @param entity_ids: the ids of the entities (resource ids, package ids, etc)
+    @return: dict containing per entity_id a dict with per tracker name the list of badges
+    """
+    trackers = [tracker for tracker in TrackerBackend.get_trackers() if tracker.show_badge]
     result = {}
-    for tracker in TrackerBackend.get_trackers():
-        if tracker.show_badge:
-            status = get_tracker_status(context, tracker, entity_type, entity_id)
-            if status is not None:
-                result[tracker.name] = [get_tracker_badge(tracker, task_status) for task_status in status]
+    for entity_id, statuses in get_latest_task_statuses(entity_type, entity_ids).items():
+        result[entity_id] = {}
+        for tracker in trackers:
+            if tracker.name in statuses:
+                result[entity_id][tracker.name] = [
+                    get_tracker_badge(tracker, task_status) for task_status in statuses[tracker.name]
+                ]
     return result
 
 
@@ -290,10 +335,40 @@ def get_tracker_badge(tracker, task_status):
     """
     if task_status is None:
         return None
+    if get_badge_mode() == BADGE_MODE_URL:
+        # Markup escapes the values it is formatted with
+        return Markup('<img src="{}" alt="{}: {}" height="20"/>').format(
+            get_tracker_badge_url(tracker.name, task_status.state), tracker.badge_title, toolkit._(task_status.state))
     return create_badge(tracker.name, tracker.badge_title, task_status.state)
 
 
+def get_tracker_badge_url(tracker_name, state):
+    """
+    Returns the URL of the (cacheable) badge of a tracker for a state, see the `tracker.badge` endpoint
+    """
+    return toolkit.url_for('tracker.badge', tracker_name=tracker_name, state=state)
+
+
+def get_badge_mode():
+    return toolkit.config.get('ckanext.tracker.badge_mode', BADGE_MODE_INLINE)
+
+
 def create_badge(identifier, title, status):
+    """
+    This method will return the svg as a string to be shown in HTML (see `render_badge`). There are only a few different
+    badges (trackers x states x languages) so the result is kept in memory
+    @param identifier: to distinguish this particular badge which should always be different
+    @param title: title to be shown (left side of the badge)
+    @param status: status to be shown (right side of the badge)
+    @return: string containing the svg code
+    """
+    return BADGE_CACHE.get_or_set(
+        (identifier, title, status, toolkit.h.lang()),
+        lambda: render_badge(identifier, title, status)
+    )
+
+
+def render_badge(identifier, title, status):
     """
     This method will create the svg as a string to be shown in HTML. It will try to calculate the width of all the
     separate elements (title, status) based on the strings
@@ -0,0 +1,117 @@
+import datetime
+import json
+
+from ckan import model
+from ckan.model import task_status_table
+from ckan.plugins import toolkit
+from sqlalchemy import and_, or_, select
+
+from ckanext.tracker_base.backend import TrackerBackend
+import ckanext.tracker_base.helpers as base_helpers
+from ckanext.tracker_base import job_table
+from ckanext.tracker_base.job_table import tracker_job_table, TrackerJob
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+ENTITY_TYPES = ['package', 'resource']
+
+
+def _parse_timestamp(value, field):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            raise toolkit.ValidationError({field: [toolkit._('Not a valid timestamp (YYYY-MM-DDTHH:MM:SS)')]})
+
+
+def _parse_cursor(cursor):
+    last_updated, _, task_id = cursor.partition('|')
+    if not task_id:
+        raise toolkit.ValidationError({'cursor': [toolkit._('Not a valid cursor')]})
+    return _parse_timestamp(last_updated, 'cursor'), task_id
+
+
+def _create_cursor(row):
+    return '{}|{}'.format(row['last_updated'].isoformat(), row['id'])
+
+
+def _activity_dict(row):
+    activity = dict(row.items())
+    activity['action'] = base_helpers.task_from_row(row).action
+    activity['last_updated'] = activity['last_updated'].isoformat() if activity['last_updated'] else None
+    try:
+        activity['value'] = json.loads(activity['value']) if activity['value'] else {}
+    except ValueError:
+        pass
+    return activity
+
+
+@toolkit.side_effect_free
+def tracker_activity_list(context, data_dict):
+    """
+    Returns the jobs (TaskStatus objects) of the trackers for an entity, newest (last updated) first, one page at a
+    time. The cost of a page does not depend on the amount of history as the next page starts where the previous one
+    ended (using the `next_cursor` of the previous page) instead of skipping an offset
+
+    :param entity_type: 'package' or 'resource'
+    :param entity_id: the id of the package or resource
+    :param tracker: the name of the tracker or a list of names (optional, defaults to all trackers showing their UI)
+    :param since: only jobs updated at or after this timestamp (optional)
+    :param until: only jobs updated before this timestamp (optional)
+    :param cursor: the `next_cursor` of the previous page (optional)
+    :param limit: the number of jobs per page (optional, default 20, max 100)
+    :returns: dict with the `activities` and the `next_cursor` (None when this was the last page)
+    """
+    entity_type = toolkit.get_or_bust(data_dict, 'entity_type')
+    entity_id = toolkit.get_or_bust(data_dict, 'entity_id')
+    if entity_type not in ENTITY_TYPES:
+        raise toolkit.ValidationError({'entity_type': [toolkit._('Should be one of {}').format(', '.join(ENTITY_TYPES))]})
+    toolkit.check_access('tracker_activity_list', context, data_dict)
+
+    entity = toolkit.get_action('{}_show'.format(entity_type))({'user': context.get('user')}, {'id': entity_id})
+    trackers = [tracker.name for tracker in TrackerBackend.get_trackers() if tracker.show_ui]
+    requested = data_dict.get('tracker')
+    if requested:
+        requested = toolkit.aslist(requested, sep=',') if not isinstance(requested, list) else requested
+        trackers = [tracker for tracker in trackers if tracker in requested]
+    try:
+        limit = min(int(data_dict.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        raise toolkit.ValidationError({'limit': [toolkit._('Invalid integer')]})
+    if not trackers or limit < 1:
+        return {'activities': [], 'next_cursor': None}
+
+    table = tracker_job_table if job_table.is_read() else task_status_table
+    conditions = [
+        table.c.entity_id == entity['id'],
+        table.c.entity_type == entity_type,
+        table.c.task_type.in_(trackers)
+    ]
+    if table is task_status_table:
+        conditions.append(table.c.key != table.c.task_type)
+    if data_dict.get('since'):
+        conditions.append(table.c.last_updated >= _parse_timestamp(data_dict['since'], 'since'))
+    if data_dict.get('until'):
+        conditions.append(table.c.last_updated < _parse_timestamp(data_dict['until'], 'until'))
+    if data_dict.get('cursor'):
+        last_updated, task_id = _parse_cursor(data_dict['cursor'])
+        conditions.append(or_(
+            table.c.last_updated < last_updated,
+            and_(table.c.last_updated == last_updated, table.c.id < task_id)
+        ))
+
+    # one row more than requested tells whether there is a next page
+    rows = model.Session.execute(
+        select([table]).where(and_(*conditions)).order_by(
+            table.c.last_updated.desc(), table.c.id.desc()
+        ).limit(limit + 1)
+    ).fetchall()
+    next_cursor = _create_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return {
+        'activities': [TrackerJob(row).as_dict() if table is tracker_job_table else _activity_dict(row)
+                       for row in rows[:limit]],
+        'next_cursor': next_cursor
+    }
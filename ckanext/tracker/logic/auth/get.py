@@ -0,0 +1,19 @@
+from ckan.plugins import toolkit
+
+
+@toolkit.auth_allow_anonymous_access
+def tracker_activity_list(context, data_dict):
+    """
+    Anyone who can see the package or resource can see the jobs of the trackers for it
+    """
+    entity_type = data_dict.get('entity_type')
+    entity_id = data_dict.get('entity_id')
+    try:
+        toolkit.check_access('{}_show'.format(entity_type), context, {'id': entity_id})
+    except toolkit.NotAuthorized:
+        return {
+            'success': False,
+            'msg': toolkit._('User {0} not authorized to read {1} {2}').format(str(context.get('user')), entity_type,
+                                                                               entity_id)
+        }
+    return {'success': True}
@@ -5,7 +5,11 @@ import ckan.plugins.toolkit as toolkit
 from ckan.lib.plugins import DefaultTranslation
 import ckanext.tracker.helpers as helpers
 from ckanext.tracker_base.backend import TrackerBackend
+from ckanext.tracker_base.cache import get_cache_stats
 import ckanext.tracker.views as views
+import ckanext.tracker.cli as cli
+import ckanext.tracker.logic.action.get as action_get
+import ckanext.tracker.logic.auth.get as auth_get
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +22,9 @@ class TrackerPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -31,10 +38,13 @@ class TrackerPlugin(plugins.SingletonPlugin, DefaultTranslation):
         return {
             'get_trackers': TrackerBackend.get_trackers,
             'get_tracker_badges': helpers.get_tracker_badges,
+            'get_tracker_badges_bulk': helpers.get_tracker_badges_bulk,
+            'get_tracker_badge_url': helpers.get_tracker_badge_url,
             'get_tracker_statuses': helpers.get_tracker_statuses,
             'get_tracker_activities': helpers.get_tracker_activities,
             'get_tracker_activities_stream': helpers.get_tracker_activities_stream,
             'get_tracker_queues': helpers.get_tracker_queues,
+            'get_tracker_cache_stats': get_cache_stats,
             'hash': helpers.hash
         }
 
@@ -42,3 +52,15 @@ class TrackerPlugin(plugins.SingletonPlugin, DefaultTranslation):
     def get_blueprint(self):
         u'''Return a Flask Blueprint object to be registered by the app.'''
         return views.tracker
+
+    # IActions
+    def get_actions(self):
+        return {'tracker_activity_list': action_get.tracker_activity_list}
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        return {'tracker_activity_list': auth_get.tracker_activity_list}
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
@@ -0,0 +1,62 @@
+/* Loads the history of the trackers for a package or resource one page at a time using the tracker_activity_list
+ * action, see ckanext/tracker/logic/action/get.py
+ *
+ * entityType - 'package' or 'resource'
+ * entityId - the id of the package or resource
+ * limit - the number of jobs to load at a time
+ */
+this.ckan.module('tracker-activity-list', function ($) {
+  return {
+    options: {
+      entityType: null,
+      entityId: null,
+      limit: 20
+    },
+
+    initialize: function () {
+      $.proxyAll(this, /_on/);
+      this.cursor = null;
+      this.body = this.$('tbody');
+      this.button = this.$('[data-action="load-more"]');
+      this.button.on('click', this._onLoadMore);
+      this.load();
+    },
+
+    load: function () {
+      var params = {
+        entity_type: this.options.entityType,
+        entity_id: this.options.entityId,
+        limit: this.options.limit
+      };
+      if (this.cursor) {
+        params.cursor = this.cursor;
+      }
+      this.button.prop('disabled', true);
+      this.sandbox.client.call('GET', 'tracker_activity_list', '?' + $.param(params), this._onLoaded, this._onError);
+    },
+
+    _onLoadMore: function (event) {
+      event.preventDefault();
+      this.load();
+    },
+
+    _onLoaded: function (response) {
+      var body = this.body;
+      $.each(response.result.activities, function (index, activity) {
+        var row = $('<tr/>').addClass(activity.state);
+        $.each([activity.task_type, activity.action || '', activity.state, activity.last_updated, activity.error || ''],
+          function (index, value) {
+            row.append($('<td/>').text(value));
+          });
+        body.append(row);
+      });
+      this.cursor = response.result.next_cursor;
+      this.button.prop('disabled', false).toggle(this.cursor !== null);
+    },
+
+    _onError: function () {
+      this.button.prop('disabled', false);
+      this.sandbox.notify(this._('An error occurred while loading the history'), 'error');
+    }
+  };
+});
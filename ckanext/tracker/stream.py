@@ -0,0 +1,162 @@
+"""
+Builds the activity stream (see `ckanext.tracker.helpers.get_tracker_activities_stream`) shown on the tracker tabs: every
+tracker gets as many lanes (columns) as it had overlapping jobs and every distinct timestamp of those jobs gets a row
+(preceded by a spacer row when it is far enough from the row above it, see `_diff`).
+
+The stream is sparse: a row only contains the cells of the lanes which change on that row, every cell spanning the rows
+(`rowspan`) until its lane changes again. So the size of the stream grows with the number of jobs instead of with the
+number of rows times the number of lanes.
+
+This module does not depend on CKAN so it can be benchmarked on its own (see `bin/benchmark_stream.py`)
+"""
+import heapq
+import math
+from datetime import datetime
+
+
+def get_timestamps(activity):
+    return [timestamp for timestamp in [activity.created, activity.pending, activity.running, activity.complete]
+            if timestamp]
+
+
+def assign_lanes(activities):
+    """
+    Divides the activities (sorted by created) over as few lanes as possible: an activity is put in the first lane
+    (lowest index) of which the last activity was complete before it was created. Instead of checking every lane for
+    every activity the busy lanes are kept on a heap (by end) and the free lanes on a heap (by index)
+    @return: list of lanes, every lane being a list of activities
+    """
+    lanes = []
+    busy = []
+    free = []
+    for activity in activities:
+        while busy and busy[0][0] < activity.created:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            index = heapq.heappop(free)
+        else:
+            index = len(lanes)
+            lanes.append([])
+        lanes[index].append(activity)
+        heapq.heappush(busy, (activity.complete if activity.complete is not None else datetime.max, index))
+    return lanes
+
+
+def _diff(timestamps, t):
+    if t + 1 >= len(timestamps):
+        return 0
+    seconds = (timestamps[t + 1] - timestamps[t]).total_seconds()
+    if seconds <= 0:
+        return 0
+    diff = math.log10(seconds)
+    return int(diff) if diff > 0 else 0
+
+
+def _cell(info, state, start, end):
+    if start or end:
+        return dict(info, state=state, start=start, end=end)
+    # the cells in between are all alike, whichever activity they belong to
+    return {"state": state, "start": False, "end": False}
+
+
+def _interval_segments(start, end, activity, info, timestamps, index, lines, tops):
+    """
+    Generates the (first line, number of lines, cell) of an activity covering the rows start to end (top to bottom)
+    """
+    yield lines[end], 1, _cell(info, activity.get_state(timestamps[end]), start == end, True)
+    if start == end:
+        return
+    # the rows in between only change where the state of the activity changes, which is at one of its own timestamps
+    bounds = sorted(set(index[timestamp] for timestamp in get_timestamps(activity)
+                        if start < index[timestamp] < end) | {start, end})
+    for k in range(len(bounds) - 1, 0, -1):
+        low, high = bounds[k - 1], bounds[k] - 1
+        # the row of the start has a cell of its own, its spacer does not
+        first, last = tops[high], lines[low] + 1 if low > start else lines[start]
+        if last > first:
+            yield first, last - first, _cell(info, activity.get_state(timestamps[low]), False, False)
+    yield lines[start], 1, _cell(info, activity.get_state(timestamps[start]), True, False)
+
+
+def _lane_segments(intervals, timestamps, index, lines, tops, n_lines):
+    """
+    Generates the (first line, number of lines, cell) of a lane from top to bottom, merging alike cells
+    """
+    previous = None
+    cursor = 0
+    for start, end, activity, info in reversed(intervals):
+        segments = [(cursor, lines[end] - cursor, None)] + list(
+            _interval_segments(start, end, activity, info, timestamps, index, lines, tops))
+        for segment in segments:
+            if segment[1] <= 0:
+                continue
+            if previous is not None and previous[2] == segment[2] and \
+                    (segment[2] is None or not (segment[2]["start"] or segment[2]["end"])):
+                previous = (previous[0], previous[1] + segment[1], previous[2])
+                continue
+            if previous is not None:
+                yield previous
+            previous = segment
+        cursor = lines[start] + 1
+    if cursor < n_lines:
+        segment = (cursor, n_lines - cursor, None)
+        if previous is not None and previous[2] is None:
+            previous = (previous[0], previous[1] + segment[1], None)
+        else:
+            if previous is not None:
+                yield previous
+            previous = segment
+    if previous is not None:
+        yield previous
+
+
+def _rows(timestamps, lanes):
+    """
+    Returns the rows (newest first, including the spacers), every row only containing the cells starting on it
+    """
+    diffs = [_diff(timestamps, t) for t in range(len(timestamps))]
+    rows = []
+    lines = [0] * len(timestamps)
+    tops = [0] * len(timestamps)
+    for t in range(len(timestamps) - 1, -1, -1):
+        tops[t] = len(rows)
+        if diffs[t] > 0:
+            rows.append({"timestamp": None, "diff": diffs[t], "cells": []})
+        lines[t] = len(rows)
+        rows.append({"timestamp": timestamps[t], "diff": diffs[t], "cells": []})
+    index = dict((timestamp, i) for i, timestamp in enumerate(timestamps))
+    for intervals in lanes:
+        for first, size, cell in _lane_segments(intervals, timestamps, index, lines, tops, len(rows)):
+            rows[first]["cells"].append({"rows": size, "activity": cell})
+    return rows
+
+
+def build_stream(activities):
+    """
+    @param activities: dict containing per tracker name the list of activities (TaskStatus objects) sorted by created
+    @return: the headers (name and number of lanes per tracker) and the (sparse) rows (newest first) of the stream
+    """
+    timestamps = sorted(set(timestamp for stream in activities.values() for activity in stream
+                            for timestamp in get_timestamps(activity)))
+    index = dict((timestamp, i) for i, timestamp in enumerate(timestamps))
+    last = len(timestamps) - 1
+    headers = []
+    lanes = []
+    for name, tracker_activities in activities.items():
+        tracker_lanes = assign_lanes(tracker_activities)
+        headers.append({
+            "name": name,
+            "size": len(tracker_lanes)
+        })
+        for lane in tracker_lanes:
+            intervals = []
+            for activity in lane:
+                start = index[activity.created]
+                end = index[activity.complete] if activity.complete is not None else last
+                intervals.append((start, max(start, end), activity, {
+                    "id": activity.id,
+                    "hash": activity.hash(),
+                    "action": activity.action
+                }))
+            lanes.append(intervals)
+    return headers, _rows(timestamps, lanes)
@@ -1,7 +1,12 @@
+import hashlib
 import logging
+import flask
 from flask import Blueprint
 from flask.views import MethodView
 import ckan.plugins.toolkit as toolkit
+import ckan.lib.helpers as h
+from ckanext.tracker.helpers import reconcile_tracker_queues, create_badge, BADGE_STATES
+from ckanext.tracker_base.backend import TrackerBackend
 
 
 logging.basicConfig()
@@ -50,7 +55,37 @@ class AdminTrackerView(MethodView):
     def get(self):
         return toolkit.render('admin/trackers.html')
 
+    def post(self):
+        """
+        Recounts all jobs on the queues of the trackers (see `reconcile_tracker_queues`)
+        """
+        try:
+            toolkit.check_access('sysadmin', {'user': toolkit.g.user})
+        except toolkit.NotAuthorized:
+            toolkit.abort(403, toolkit._('Need to be system administrator to administer'))
+        reconcile_tracker_queues()
+        h.flash_success(toolkit._('The job counters have been recounted'))
+        return h.redirect_to('tracker.admin')
+
+
+class BadgeTrackerView(MethodView):
+
+    def get(self, tracker_name, state):
+        """
+        Serves the badge of a tracker for a state as an image which can be cached by browsers and proxies
+        """
+        tracker_model = TrackerBackend.get_tracker(tracker_name)
+        if tracker_model is None or not tracker_model.badge_title or state not in BADGE_STATES:
+            toolkit.abort(404, toolkit._('Badge not found'))
+        svg = create_badge(tracker_model.name, tracker_model.badge_title, state).strip()
+        response = flask.Response(svg, mimetype='image/svg+xml')
+        response.set_etag(hashlib.md5(svg.encode('utf-8')).hexdigest())
+        response.cache_control.public = True
+        response.cache_control.max_age = int(toolkit.config.get('ckanext.tracker.badge_max_age', 3600))
+        return response.make_conditional(flask.request)
+
 
 tracker.add_url_rule(u'/dataset/<id>/resource/<resource_id>/trackers', view_func=ResourceTrackerView.as_view(str(u'resource')))
 tracker.add_url_rule(u'/dataset/<id>/trackers', view_func=PackageTrackerView.as_view(str(u'package')))
 tracker.add_url_rule(u'/ckan-admin/trackers', view_func=AdminTrackerView.as_view(str(u'admin')))
+tracker.add_url_rule(u'/tracker/badge/<tracker_name>/<state>.svg', view_func=BadgeTrackerView.as_view(str(u'badge')))
@@ -1,8 +1,11 @@
 import ckanext.tracker_base.helpers as base_helpers
+import datetime
 import logging
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckanext.tracker_base.backend import TrackerBackend
+from ckanext.tracker_base.model import PlannedJob
+from ckanext.tracker_base import coalesce, envelope, stats
 from domain import Configuration
 from ckan.model import Resource, Package
 from worker import WorkerWrapper
@@ -10,11 +13,169 @@ from mapper.mapper import Mapper
 from rq import Queue
 from rq.job import Job
 from redis import Redis
-from domain.task_status import PENDING, ERROR
+from domain.task_status import PENDING, ERROR, COMPLETE
 
 log = logging.getLogger(__name__)
 
 
+def get_job_context(context):
+    """
+    Returns the context used for handling the TaskStatus objects of the jobs
+    """
+    job_context = context.copy()
+    # Added ignore_auth header, because the context.user and context.user_auth_obj have information about the user performing this action.
+    # The user is not necessarly a sysadmin, and the task_status_update call only authorizes sysadmins to perform it.
+    # Therefore we need to ignore the authorization otherwise this action is not sucessfull for users who are not sysadmin.
+    job_context['ignore_auth'] = True
+    # the TaskStatus objects are written using a session of their own, which is therefore also committed right away
+    job_context['session'] = context['model'].meta.create_local_session()
+    job_context.pop('defer_commit', None)
+    return job_context
+
+
+def submit_jobs(context, planned_jobs):
+    """
+    This method will put all planned jobs (see `PlannedJob`) on their queues, giving the correct feedback. The
+    TaskStatus objects of all jobs are inserted using a single statement and all jobs are written to Redis using a single
+    pipeline (all trackers use the same Redis instance, see `ckan.redis.url`)
+    """
+    planned_jobs = prepare_jobs(context, planned_jobs)
+    if not planned_jobs:
+        return
+    job_context = get_job_context(context)
+    try:
+        tasks = []
+        for planned_job in planned_jobs:
+            planned_job.job = planned_job.tracker.create_job(
+                envelope.execute if planned_job.compact else planned_job.command)
+            task = base_helpers.new_task(
+                planned_job.job, planned_job.tracker.name, planned_job.entity_type,
+                planned_job.res_dict, planned_job.pkg_dict, planned_job.action())
+            task.set_state(PENDING, None, None)
+            tasks.append(task)
+        for planned_job, task in zip(planned_jobs, base_helpers.create_tasks(job_context, tasks)):
+            planned_job.task = task
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while creating the tasks: {}".format(unexpected_error))
+        return
+
+    connection = planned_jobs[0].tracker.get_connection()
+    keys = [planned_job.tracker.get_coalesce_key(planned_job) for planned_job in planned_jobs]
+    try:
+        waiting = dict(zip([key for key in keys if key], coalesce.get_waiting(connection, [key for key in keys if key])))
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while looking up the waiting jobs: {}".format(unexpected_error))
+        waiting = {}
+
+    pipeline = connection.pipeline()
+    enqueued = []
+    failed = []
+    for planned_job, key in zip(planned_jobs, keys):
+        try:
+            if planned_job.compact:
+                planned_job.tracker.enqueue_envelope(
+                    planned_job.job, planned_job.entity_type, planned_job.task.id, planned_job.command,
+                    planned_job.res_dict, planned_job.pkg_dict, pipeline=pipeline)
+            else:
+                planned_job.tracker.enqueue_job(
+                    context, planned_job.job, planned_job.entity_type, planned_job.task.id,
+                    planned_job.res_dict, planned_job.pkg_dict, pipeline=pipeline, data=planned_job.data)
+            if key:
+                coalesce.register(pipeline, key, planned_job.job.id, planned_job.task.id)
+            stats.increment(pipeline, planned_job.tracker.get_queue_name(), planned_job.tracker.name, stats.QUEUED)
+            enqueued.append(planned_job)
+        except Exception as unexpected_error:
+            log.error("An unexpected error occurred: {}".format(unexpected_error))
+            planned_job.task.set_state(ERROR, None, str(unexpected_error))
+            failed.append(planned_job)
+    try:
+        pipeline.execute()
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while writing the jobs to Redis: {}".format(unexpected_error))
+        for planned_job in enqueued:
+            planned_job.task.set_state(ERROR, None, str(unexpected_error))
+            failed.append(planned_job)
+        enqueued = []
+    if failed:
+        base_helpers.update_tasks(job_context, [planned_job.task for planned_job in failed])
+        count_failed_jobs(connection, failed)
+    supersede_waiting_jobs(job_context, connection, enqueued, waiting)
+
+
+def count_failed_jobs(connection, failed):
+    """
+    Counts the jobs which could not be put on their queue as failed (see `ckanext.tracker_base.stats`), their TaskStatus
+    is updated directly so the counters are not updated by `task_status_update`
+    """
+    try:
+        pipeline = connection.pipeline()
+        for planned_job in failed:
+            stats.increment(pipeline, planned_job.tracker.get_queue_name(), planned_job.tracker.name, stats.FAILED)
+        pipeline.execute()
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while counting the failed jobs: {}".format(unexpected_error))
+
+
+def prepare_jobs(context, planned_jobs):
+    """
+    Coalesces the planned jobs and builds the data of the jobs not using a compact payload. Building the data might need
+    the request (e.g. for url_for), so when the jobs are submitted on another thread (see
+    `ckanext.tracker_base.dispatch`) this already happens on the thread of the request
+    """
+    planned_jobs = coalesce_planned_jobs(planned_jobs)
+    for planned_job in planned_jobs:
+        planned_job.compact = planned_job.tracker.use_compact_payload(planned_job)
+        if not planned_job.compact and planned_job.data is None:
+            planned_job.data = planned_job.tracker.get_job_data(
+                context, planned_job.entity_type, planned_job.command.__name__, planned_job.res_dict,
+                planned_job.pkg_dict)
+    return planned_jobs
+
+
+def coalesce_planned_jobs(planned_jobs):
+    """
+    Only keeps the last of the planned jobs sharing the same coalesce key (see `get_coalesce_key`)
+    """
+    keys = [planned_job.tracker.get_coalesce_key(planned_job) for planned_job in planned_jobs]
+    last = {key: index for index, key in enumerate(keys) if key}
+    return [planned_job for index, (planned_job, key) in enumerate(zip(planned_jobs, keys))
+            if not key or last[key] == index]
+
+
+def supersede_waiting_jobs(job_context, connection, enqueued, waiting):
+    """
+    Removes the jobs which were still waiting for the same entity and command as the jobs which were just enqueued and
+    marks their TaskStatus as superseded (`coalesce.SUPERSEDED` with a message referring to the new job)
+    """
+    superseded = {}
+    for planned_job in enqueued:
+        previous = waiting.get(planned_job.tracker.get_coalesce_key(planned_job))
+        if previous is not None and previous[0] != planned_job.job.id:
+            queue_name = planned_job.tracker.get_queue_name()
+            superseded.setdefault(queue_name, (planned_job.tracker.get_queue(), []))[1].append(
+                (previous, planned_job.job.id, planned_job.tracker.name))
+    if not superseded:
+        return
+    try:
+        messages = {}
+        for queue, entries in superseded.values():
+            removed = set(coalesce.remove_waiting(connection, queue, [previous[0] for previous, _, _ in entries]))
+            for (job_id, task_id), new_job_id, plugin_name in entries:
+                if job_id in removed:
+                    messages[task_id] = 'superseded by job {}'.format(new_job_id)
+                    stats.increment(connection, queue.name, plugin_name, stats.QUEUED, -1)
+        tasks = base_helpers.show_tasks(job_context, messages.keys())
+        for task_id, task in tasks.items():
+            # finishing the task like a COMPLETE one sets its timestamps, the state itself tells it apart
+            task.set_state(COMPLETE, None, messages[task_id])
+            task.state = coalesce.SUPERSEDED
+        base_helpers.update_tasks(job_context, list(tasks.values()))
+        if tasks:
+            log.debug("Superseded {} waiting job(s)".format(len(tasks)))
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while superseding the waiting jobs: {}".format(unexpected_error))
+
+
 class BaseTrackerPlugin(plugins.SingletonPlugin):
     """
     This Plugin contains all the logic necessary to have access to the queues/workers/mappers, feedback and
@@ -22,12 +183,18 @@ class BaseTrackerPlugin(plugins.SingletonPlugin):
     """
     plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IMapper, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     queue_name = None  # type: str
     configuration = None  # type: Configuration
     worker = None  # type: WorkerWrapper
     redis_connection = None  # type: Redis
     mapper = None  # type: Mapper
+    configuration_hash = None  # type: str
+
+    job_data_parts = None  # type: list
+    coalesce_jobs = False  # type: bool
+    debounce_seconds = 0  # type: int
 
     badge_title = None  # type: str
     show_ui = True  # type: bool
@@ -42,7 +209,16 @@ class BaseTrackerPlugin(plugins.SingletonPlugin):
         if self.queue_name is None:
             self.queue_name = self.name
         self.redis_connection = base_helpers.set_connection()
-        self.configuration = Configuration.from_dict(base_helpers.get_configuration_dict(self.name))
+        conf_dict = base_helpers.get_configuration_dict(self.name)
+        self.configuration = Configuration.from_dict(conf_dict)
+        if self.get_compact_payload():
+            try:
+                self.configuration_hash = envelope.store_configuration(self.redis_connection, self.name, conf_dict,
+                                                                       self.get_worker(), self.mapper)
+            except Exception as unexpected_error:
+                log.error("{}: could not store the configuration, jobs will carry the full payload: {}".format(
+                    self.name, unexpected_error))
+        base_helpers.configure_caches()
         TrackerBackend.register(self)
 
     # Getters
@@ -58,6 +234,16 @@ class BaseTrackerPlugin(plugins.SingletonPlugin):
     def get_queue_name(self):
         return self.queue_name
 
+    def get_compact_payload(self):
+        return toolkit.asbool(toolkit.config.get('ckanext.{}.compact_payload'.format(self.name), False))
+
+    def get_debounce_seconds(self):
+        return int(toolkit.config.get('ckanext.{}.debounce_seconds'.format(self.name), self.debounce_seconds) or 0)
+
+    def get_coalesce_jobs(self):
+        return toolkit.asbool(toolkit.config.get('ckanext.{}.coalesce_jobs'.format(self.name), self.coalesce_jobs)) \
+            or self.get_debounce_seconds() > 0
+
     # UI related methods (see TrackerPlugin)
     def get_badge_title(self):
         # TODO Sugestion: set self.badge_title to default to the class name...
@@ -77,29 +263,16 @@ class BaseTrackerPlugin(plugins.SingletonPlugin):
     # QUEUE / JOB RELATED METHODS
     def put_on_a_queue(self, context, entity_type, command, res_dict, pkg_dict, res_changes, pkg_changes):
         """
-        This method will make sure a job is created and put on the queue and giving the correct feedback
+        This method will make sure a job is created and put on the queue and giving the correct feedback. Within a
+        tracked action (see `PackageResourceTrackerPlugin`) the job is collected and submitted together with all other
+        jobs once the outermost action is finished
         """
-        task = None
-        job_context = context.copy()
-        # Added ignore_auth header, because the context.user and context.user_auth_obj have information about the user performing this action.
-        # The user is not necessarly a sysadmin, and the task_status_update call only authorizes sysadmins to perform it.
-        # Therefore we need to ignore the authorization otherwise this action is not sucessfull for users who are not sysadmin.
-        job_context['ignore_auth'] = True
-        job_context['session'] = context['model'].meta.create_local_session()
-        try:
-            job = self.create_job(command)
-            task = base_helpers.create_task(job_context, job, self.name, entity_type, res_dict, pkg_dict)
-            if task:
-                task_id = task.id
-            else:
-                task_id = None
-            self.enqueue_job(context, job, entity_type, task_id, res_dict, pkg_dict)
-            if task is not None:
-                base_helpers.update_task(job_context, task, state=PENDING)
-        except Exception as unexpected_error:
-            log.error("An unexpected error occurred: {}".format(unexpected_error))
-            if task is not None:
-                base_helpers.update_task(job_context, task, state=ERROR, error=unexpected_error.message)
+        planned_job = PlannedJob(self, entity_type, command, res_dict, pkg_dict,
+                                 compact=not context.get('tracker_full_payload', False))
+        if context.get('tracker') is not None:
+            context['tracker'].add_job(planned_job)
+        else:
+            submit_jobs(context, [planned_job])
 
     def create_job(self, command):
         """
@@ -114,15 +287,108 @@ class BaseTrackerPlugin(plugins.SingletonPlugin):
             ttl=configuration.redis_job_ttl
         )
 
-    def enqueue_job(self, context, job, entity_type, task_id, res_dict, pkg_dict):
-        q = Queue(self.get_queue_name(), connection=self.get_connection())
-        job.args = base_helpers.get_data(context, self.configuration, entity_type, task_id, self.mapper, res_dict, pkg_dict)
+    def get_job_data_parts(self, entity_type, command):
+        """
+        Returns the parts of the job data (see `JOB_DATA_PARTS`) the worker needs for a command (the name of the
+        function), None meaning all parts. Can be overridden for all commands using `ckanext.{plugin}.job_data_parts`
+        """
+        parts = toolkit.config.get('ckanext.{}.job_data_parts'.format(self.name), None)
+        if parts:
+            return toolkit.aslist(parts)
+        return self.job_data_parts
+
+    def get_data_context(self, context):
+        """
+        Returns the context used to retrieve the data of a job (see `enqueue_job`), by default the context of the action
+        """
+        return context
+
+    def get_queue(self):
+        return Queue(self.get_queue_name(), connection=self.get_connection())
+
+    def get_coalesce_key(self, planned_job):
+        """
+        Returns the key used to coalesce the jobs for the same entity and command (see `ckanext.tracker_base.coalesce`)
+        or None when this tracker (or the job) does not coalesce
+        """
+        if not planned_job.coalesce or not self.get_coalesce_jobs():
+            return None
+        return coalesce.get_key(self.name, planned_job.entity_type, planned_job.entity_id(), planned_job.action())
+
+    def enqueue(self, job, pipeline=None):
+        """
+        Puts the job on the queue, or when debouncing (see `get_debounce_seconds`) schedules it to be put on the queue
+        once the debounce window has passed (which requires the workers to run with a scheduler)
+        """
+        q = self.get_queue()
+        debounce_seconds = self.get_debounce_seconds()
+        if debounce_seconds > 0 and not hasattr(q, 'schedule_job'):
+            log.warning("{}: scheduling jobs requires rq 1.2 or newer, not debouncing".format(self.name))
+            debounce_seconds = 0
+        if debounce_seconds > 0:
+            q.schedule_job(job, datetime.datetime.utcnow() + datetime.timedelta(seconds=debounce_seconds),
+                           pipeline=pipeline)
+        else:
+            q.enqueue_job(job, pipeline=pipeline)
+
+    def get_job_data(self, context, entity_type, command, res_dict, pkg_dict, task_id=None):
+        """
+        Returns the data the worker needs for a command (the name of the function), see `base_helpers.get_data`
+        """
+        return base_helpers.get_data(self.get_data_context(context), self.configuration, entity_type, task_id,
+                                     self.mapper, res_dict, pkg_dict, self.get_job_data_parts(entity_type, command))
+
+    def enqueue_job(self, context, job, entity_type, task_id, res_dict, pkg_dict, pipeline=None, data=None):
+        """
+        This method will add the data (built now when not given, see `prepare_jobs`) to the job and enqueue it, when a
+        pipeline is given the job will only be written to Redis when that pipeline is executed
+        """
+        if data is None:
+            data = self.get_job_data(context, entity_type, job.func_name, res_dict, pkg_dict)
+        # the configuration is shared by the jobs, the job is pickled (so gets its own task id) when it is enqueued
+        data[0].task_status_id = task_id
+        job.args = data
         job.description = 'Job for action [{}] on {} [{}] created by {}'.format(
             job.func_name,
             entity_type,
             res_dict.get("id") if entity_type == 'resource' else pkg_dict.get("id"),
             self.name)
-        q.enqueue_job(job)
+        self.enqueue(job, pipeline=pipeline)
+
+    def use_compact_payload(self, planned_job):
+        """
+        A compact payload (see `ckanext.tracker_base.envelope`) can only be used when the worker will still be able to
+        retrieve the entity, so not for purged entities (see `tracker_full_payload`) or deleted resources
+        """
+        if not planned_job.compact or self.configuration_hash is None:
+            return False
+        if planned_job.entity_type == 'resource':
+            return base_helpers.is_active(planned_job.res_dict)
+        return True
+
+    def enqueue_envelope(self, job, entity_type, task_id, command, res_dict, pkg_dict, pipeline=None):
+        """
+        This method will add a compact envelope referring to the configuration and entities to the job (see
+        `ckanext.tracker_base.envelope.execute`) and enqueue it
+        """
+        configuration = self.get_configuration()
+        job.args = (envelope.create_envelope(
+            self.name, configuration.source_ckan_host, self.configuration_hash, command, entity_type, task_id,
+            self.get_worker(), self.get_job_data_parts(entity_type, command.__name__) or base_helpers.JOB_DATA_PARTS,
+            res_dict, pkg_dict),)
+        job.description = 'Job for action [{}] on {} [{}] created by {}'.format(
+            command.__name__,
+            entity_type,
+            res_dict.get("id") if entity_type == 'resource' else pkg_dict.get("id"),
+            self.name)
+        self.enqueue(job, pipeline=pipeline)
+
+    # IOrganizationController
+    def edit(self, entity):
+        base_helpers.invalidate_organization(entity.id)
+
+    def delete(self, entity):
+        base_helpers.invalidate_organization(entity.id)
 
     # IMapper
     def after_delete(self, mapper, connection, instance):
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+# all caches created in this process, see `get_cache_stats`
+_caches = OrderedDict()
+
+
+class TTLCache(object):
+    """
+    Small thread safe and process local cache. Entries expire after `ttl` seconds (never when `ttl` is None) and the
+    least recently used entries are evicted when more than `maxsize` entries are stored. Keeps track of hits and misses.
+    When `sliding` the `ttl` counts from the last time an entry was used instead of from when it was stored. The optional
+    `on_evict` is called with every value which is removed (evicted, expired, replaced, invalidated or cleared), e.g. to
+    release the resources held by that value
+    """
+
+    def __init__(self, name, maxsize=128, ttl=None, sliding=False, on_evict=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        _caches[name] = self
+
+    def _is_expired(self, timestamp):
+        return self.ttl is not None and time.time() - timestamp > self.ttl
+
+    def _evict(self, values):
+        # called outside of the lock, so a slow `on_evict` doesn't block the other threads
+        if self.on_evict is not None:
+            for value in values:
+                self.on_evict(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and not self._is_expired(entry[0]):
+                # re-insert to mark the entry as most recently used
+                self._entries[key] = (time.time(), entry[1]) if self.sliding else entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        self._evict([entry[1]] if entry is not None else [])
+        return default
+
+    def set(self, key, value):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            evicted = [previous[1]] if previous is not None and previous[1] is not value else []
+            self._entries[key] = (time.time(), value)
+            # the least recently used entries are evicted, as are the expired ones in front of them
+            while len(self._entries) > self.maxsize or self._is_expired(next(iter(self._entries.values()))[0]):
+                evicted.append(self._entries.popitem(last=False)[1][1])
+        self._evict(evicted)
+
+    def get_or_set(self, key, create):
+        """
+        Returns the cached value for the key or stores and returns the result of `create()` (which is not stored when
+        it returns None)
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        self._evict([entry[1]] if entry is not None else [])
+
+    def clear(self):
+        with self._lock:
+            evicted = [entry[1] for entry in self._entries.values()]
+            self._entries.clear()
+        self._evict(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+def get_cache_stats():
+    """
+    Returns the stats (size, hits, misses, etc) of all caches in this process
+    """
+    return [cache.stats() for cache in _caches.values()]
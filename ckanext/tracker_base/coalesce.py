@@ -0,0 +1,68 @@
+"""
+Coalescing of jobs per (tracker, entity_type, entity_id, command). For every job which is put on a queue a small key is
+kept in Redis referring to that job and its TaskStatus. When a newer job for the same key is put on the queue while the
+older one is still waiting (queued or, when debouncing, scheduled) the older one is removed from the queue.
+"""
+from rq.job import Job
+try:
+    from rq.registry import ScheduledJobRegistry
+except ImportError:
+    # rq < 1.2 can't schedule jobs, so there are no scheduled jobs to remove either
+    ScheduledJobRegistry = None
+
+COALESCE_KEY = 'ckanext-tracker:coalesce:{tracker}:{entity_type}:{entity_id}:{command}'
+
+# the keys only need to live as long as the jobs are waiting, a stale key is harmless (nothing will be removed)
+COALESCE_TTL = 24 * 60 * 60
+
+# terminal state of the TaskStatus of a removed job (see `ckanext.tracker_base.base_tracker.supersede_waiting_jobs`),
+# such a job is neither unfinished nor the last finished job of its entity
+SUPERSEDED = 'superseded'
+
+
+def get_key(tracker_name, entity_type, entity_id, command):
+    return COALESCE_KEY.format(tracker=tracker_name, entity_type=entity_type, entity_id=entity_id, command=command)
+
+
+def _decode(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    job_id, _, task_id = value.partition(':')
+    return job_id, task_id
+
+
+def get_waiting(connection, keys):
+    """
+    Returns the (job_id, task_id) of the last job registered for every key (None when there is none) using a single
+    round trip
+    """
+    if not keys:
+        return []
+    return [_decode(value) for value in connection.mget(keys)]
+
+
+def register(pipeline, key, job_id, task_id, ttl=COALESCE_TTL):
+    pipeline.set(key, '{}:{}'.format(job_id, task_id), ex=ttl)
+
+
+def remove_waiting(connection, queue, job_ids):
+    """
+    Removes the jobs from the queue and its scheduled registry, returning the ids of the jobs which were actually
+    removed (jobs which were already picked up by a worker are left alone)
+    """
+    if not job_ids:
+        return []
+    registry = ScheduledJobRegistry(queue=queue) if ScheduledJobRegistry is not None else None
+    pipeline = connection.pipeline()
+    for job_id in job_ids:
+        queue.remove(job_id, pipeline=pipeline)
+        if registry is not None:
+            registry.remove(job_id, pipeline=pipeline)
+    results = pipeline.execute()
+    step = 2 if registry is not None else 1
+    removed = [job_id for index, job_id in enumerate(job_ids) if any(results[step * index:step * (index + 1)])]
+    if removed:
+        connection.delete(*[Job.key_for(job_id) for job_id in removed])
+    return removed
@@ -1,35 +1,205 @@
+import copy
+import json
 import logging
+from ckan import model
 from ckan.plugins import toolkit
+from sqlalchemy import and_, or_, select
 
 log = logging.getLogger(__name__)
 
+SNAPSHOT_MODE_SHOW = 'show'
+SNAPSHOT_MODE_DB = 'db'
+
+# fields which are always part of a snapshot as they are needed to determine created/deleted packages and resources
+BASE_SNAPSHOT_FIELDS = ['id', 'state']
+
+# fields which change on every update, a db snapshot reading all fields leaves them out (unless asked for explicitly) as
+# otherwise every action would look like a change
+VOLATILE_SNAPSHOT_FIELDS = ['metadata_modified', 'revision_id']
+
+# Process wide counters to keep an eye on the cost of the snapshots, see `get_stats`
+_stats = {
+    'contexts': 0,
+    'package_show': 0,
+    'db_snapshot': 0,
+    'trackers': 0
+}
+
+# Union of the fields the registered trackers compare, None meaning all fields (see `register_snapshot_fields`)
+_snapshot_fields = {
+    'package': set(BASE_SNAPSHOT_FIELDS),
+    'resource': set(BASE_SNAPSHOT_FIELDS)
+}
+
 
 def get_show(object_type, object_id):
+    key = '{}_show'.format(object_type)
+    _stats[key] = _stats.get(key, 0) + 1
     return toolkit.get_action('{}_show'.format(object_type))({'ignore_auth': True}, {'id': object_id})
 
 
+def register_snapshot_fields(package_fields, resource_fields):
+    """
+    Adds the fields a tracker compares to the fields read by the lightweight (db) snapshot. A value of None means the
+    tracker compares all fields, which means the snapshot will read all columns and extras
+    """
+    for object_type, fields in [('package', package_fields), ('resource', resource_fields)]:
+        if fields is None:
+            _snapshot_fields[object_type] = None
+        elif _snapshot_fields[object_type] is not None:
+            _snapshot_fields[object_type].update(fields)
+
+
+def _select_columns(table, fields):
+    if fields is None:
+        return [column for column in table.c if column.name not in VOLATILE_SNAPSHOT_FIELDS]
+    return [column for column in table.c if column.name in fields]
+
+
+def _add_extras(data_dict, extras, fields):
+    for key, value in extras:
+        if key not in data_dict and (key in fields if fields is not None else key not in VOLATILE_SNAPSHOT_FIELDS):
+            data_dict[key] = value
+
+
+def get_db_snapshot(package_id, package_fields=None, resource_fields=None):
+    """
+    Reads only the given fields (None meaning all but the `VOLATILE_SNAPSHOT_FIELDS`) of a package, its extras and its active resources straight from the
+    database. This skips everything a package_show does (validation, after_show hooks, etc.) and therefore is only
+    meant to compare two snapshots with each other, not to be used as a package dict for jobs
+    """
+    _stats['db_snapshot'] += 1
+    package_table = model.package_table
+    extra_table = model.package_extra_table
+    resource_table = model.resource_table
+
+    package_columns = set(_select_columns(package_table, package_fields) + [package_table.c.id])
+    rows = model.Session.execute(
+        select(list(package_columns) + [extra_table.c.key, extra_table.c.value]).select_from(
+            package_table.outerjoin(extra_table, and_(
+                extra_table.c.package_id == package_table.c.id,
+                extra_table.c.state == model.State.ACTIVE
+            ))
+        ).where(or_(package_table.c.id == package_id, package_table.c.name == package_id))
+    ).fetchall()
+    if not rows:
+        return None
+    pkg_dict = {column.name: rows[0][column] for column in package_columns}
+    _add_extras(pkg_dict, [(row[extra_table.c.key], row[extra_table.c.value]) for row in rows
+                           if row[extra_table.c.key] is not None], package_fields)
+
+    resource_columns = set(_select_columns(resource_table, resource_fields) + [resource_table.c.extras])
+    resources = []
+    for row in model.Session.execute(
+            select(list(resource_columns)).where(and_(
+                resource_table.c.package_id == pkg_dict['id'],
+                resource_table.c.state == model.State.ACTIVE
+            )).order_by(resource_table.c.position)):
+        res_dict = {column.name: row[column] for column in resource_columns if column.name != 'extras'}
+        extras = row[resource_table.c.extras] or {}
+        if not isinstance(extras, dict):
+            extras = json.loads(extras)
+        _add_extras(res_dict, extras.items(), resource_fields)
+        resources.append(res_dict)
+    pkg_dict['resources'] = resources
+    return pkg_dict
+
+
+def get_stats():
+    """
+    Returns a copy of the counters of all TrackerContexts in this process. `package_show` divided by `contexts` should
+    never exceed 2, no matter how many trackers (`trackers`) took part in the actions
+    """
+    return dict(_stats)
+
+
 class TrackerContext(object):
+    """
+    Request scoped snapshot of a package which is shared by all trackers chaining the same action. The before and after
+    snapshots are only taken once for the outermost action and every tracker gets its own copy of them (so one tracker
+    can't change what another tracker sees).
+
+    With `ckanext.tracker.snapshot_mode = db` the before and after snapshots are read straight from the database
+    (see `get_db_snapshot`) and the complete package (`package_dict`) is only retrieved once a tracker has something
+    to act upon
+    """
 
     def __init__(self, package_id=None):
         super(TrackerContext, self).__init__()
+        self._mode = toolkit.config.get('ckanext.tracker.snapshot_mode', SNAPSHOT_MODE_SHOW)
         self._before_package = None
         self._after_package = None
+        self._package_id = None
+        self._package_dict = None
         self._depth = 0
+        self._trackers = []
+        self._jobs = []
+        self._show_count = 0
+        _stats['contexts'] += 1
         self.before(package_id)
 
+    def _show(self, package_id):
+        self._show_count = self._show_count + 1
+        return get_show('package', package_id)
+
+    def _snapshot(self, package_id):
+        if self.is_partial():
+            return get_db_snapshot(package_id, _snapshot_fields['package'], _snapshot_fields['resource'])
+        return self._show(package_id)
+
+    def is_partial(self):
+        """
+        True when the before and after snapshots only contain the compared fields
+        """
+        return self._mode == SNAPSHOT_MODE_DB
+
     def before(self, package_id):
         if package_id is not None:
-            self._before_package = get_show('package', package_id)
+            self._before_package = self._snapshot(package_id)
 
     def after(self, package_id):
         if package_id is not None:
-            self._after_package = get_show('package', package_id)
+            self._package_id = package_id
+            self._after_package = self._snapshot(package_id)
 
     def before_package(self):
-        return self._before_package
+        return copy.deepcopy(self._before_package)
 
     def after_package(self):
-        return self._after_package
+        return copy.deepcopy(self._after_package)
+
+    def package_dict(self):
+        """
+        The complete package after the action (as returned by package_show) to be used for the jobs
+        """
+        if not self.is_partial():
+            return self.after_package()
+        if self._package_dict is None and self._package_id is not None:
+            self._package_dict = self._show(self._package_id)
+        return copy.deepcopy(self._package_dict)
+
+    def register(self, tracker):
+        """
+        Adds a tracker taking part in this action (only once, also when it is part of nested actions)
+        """
+        if tracker not in self._trackers:
+            self._trackers.append(tracker)
+            _stats['trackers'] += 1
+
+    def trackers(self):
+        return list(self._trackers)
+
+    def add_job(self, planned_job):
+        """
+        Collects a job planned by one of the trackers, all jobs are submitted at once after the outermost action
+        """
+        self._jobs.append(planned_job)
+
+    def jobs(self):
+        return list(self._jobs)
+
+    def show_count(self):
+        return self._show_count
 
     def enter(self):
         self._depth = self._depth + 1
@@ -0,0 +1,94 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import flask
+from ckan import model
+from ckan.plugins import toolkit
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from ckanext.tracker_base.base_tracker import prepare_jobs, submit_jobs
+
+log = logging.getLogger(__name__)
+
+DISPATCH_MODE_INLINE = 'inline'
+DISPATCH_MODE_DEFERRED = 'deferred'
+
+# key in `Session.info` used to buffer the planned jobs until the transaction is committed
+SESSION_INFO_KEY = 'tracker_planned_jobs'
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_dispatch_mode():
+    return toolkit.config.get('ckanext.tracker.dispatch_mode', DISPATCH_MODE_INLINE)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(int(toolkit.config.get('ckanext.tracker.dispatch_threads', 2)))
+    return _pool
+
+
+def _submit(app, context, planned_jobs):
+    """
+    Submits the jobs on one of the threads of the pool. Everything needing the request (the job data, see
+    `prepare_jobs`) was already built on the thread of the request, so only an app context is needed here
+    """
+    try:
+        if app is not None:
+            with app.app_context():
+                submit_jobs(context, planned_jobs)
+        else:
+            submit_jobs(context, planned_jobs)
+    except Exception as unexpected_error:
+        log.error("An unexpected error occurred while dispatching {} job(s): {}".format(
+            len(planned_jobs), unexpected_error))
+    finally:
+        model.Session.remove()
+
+
+def _dispatch_in_background(context, planned_jobs):
+    app = flask.current_app._get_current_object() if flask.has_app_context() else None
+    _get_pool().apply_async(_submit, (app, context, planned_jobs))
+
+
+def dispatch_jobs(context, planned_jobs):
+    """
+    Submits the planned jobs of a tracked action. In the (default) inline mode this happens right away, in the deferred
+    mode the jobs are prepared right away and submitted on a small pool of background threads once the transaction is
+    committed. When the action did not commit itself (`defer_commit`) the jobs are kept on the session until it is
+    committed and discarded when it is rolled back
+    """
+    if not planned_jobs:
+        return
+    if get_dispatch_mode() != DISPATCH_MODE_DEFERRED:
+        submit_jobs(context, planned_jobs)
+        return
+    dispatch_context = {'model': model, 'user': context.get('user')}
+    planned_jobs = prepare_jobs(dispatch_context, planned_jobs)
+    if context.get('defer_commit'):
+        session = context.get('session', model.Session)
+        if session is model.Session:
+            session = model.Session()
+        session.info.setdefault(SESSION_INFO_KEY, []).append((dispatch_context, planned_jobs))
+    else:
+        _dispatch_in_background(dispatch_context, planned_jobs)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for dispatch_context, planned_jobs in session.info.pop(SESSION_INFO_KEY, []):
+        _dispatch_in_background(dispatch_context, planned_jobs)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    buffered = session.info.pop(SESSION_INFO_KEY, [])
+    if buffered:
+        log.info("Discarded {} planned job(s) because the transaction was rolled back".format(
+            sum(len(planned_jobs) for _, planned_jobs in buffered)))
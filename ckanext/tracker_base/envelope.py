@@ -0,0 +1,169 @@
+"""
+Compact job payloads. Instead of pickling the Configuration and the mapped package/resource into every job, a job only
+carries a small envelope referring to the configuration (stored once in Redis by the plugin, see
+`store_configuration`) and the ids of the entities. The WorkerWrapper and Mapper of the plugin are not pickled into the
+job either, the stored configuration names their classes and the worker creates them itself. The worker resolves all of
+these using `execute`.
+
+This module is imported by the workers, so it should not depend on CKAN itself.
+"""
+import copy
+import hashlib
+import json
+import logging
+
+from domain import Configuration, Package, Resource, DataDictionary
+from rq import get_current_connection
+from rq.utils import import_attribute
+
+from ckanext.tracker_base.remote import RemoteCkan
+
+log = logging.getLogger(__name__)
+
+ENVELOPE_VERSION = 2
+
+CONFIGURATION_KEY = 'ckanext-tracker:configuration:{plugin}:{hash}'
+
+GEONETWORK_ORGANIZATION_FIELDS = ['geonetwork_url', 'geonetwork_password', 'geonetwork_username']
+
+
+def get_class_path(instance):
+    if instance is None:
+        return None
+    return '{}.{}'.format(type(instance).__module__, type(instance).__name__)
+
+
+def store_configuration(connection, plugin_name, conf_dict, worker=None, mapper=None):
+    """
+    Stores the configuration of a plugin and the classes of its WorkerWrapper and Mapper in Redis (once for every version
+    of these) and returns the hash used to refer to it
+    """
+    conf_json = json.dumps({
+        'configuration': conf_dict,
+        'worker': get_class_path(worker),
+        'mapper': get_class_path(mapper)
+    }, sort_keys=True, default=str)
+    conf_hash = hashlib.md5(conf_json.encode('utf-8')).hexdigest()
+    connection.set(CONFIGURATION_KEY.format(plugin=plugin_name, hash=conf_hash), conf_json)
+    return conf_hash
+
+
+def load_configuration(connection, envelope):
+    """
+    Returns the configuration and a new instance of the WorkerWrapper and Mapper (None when the plugin has none)
+    """
+    conf_json = connection.get(CONFIGURATION_KEY.format(plugin=envelope['plugin'], hash=envelope['configuration']))
+    if conf_json is None:
+        raise LookupError("configuration {} of {} could not be found".format(
+            envelope['configuration'], envelope['plugin']))
+    if isinstance(conf_json, bytes):
+        conf_json = conf_json.decode('utf-8')
+    stored = json.loads(conf_json)
+    configuration = Configuration.from_dict(stored['configuration'])
+    configuration.task_status_id = envelope['task_id']
+    worker = import_attribute(stored['worker'])() if stored['worker'] else None
+    mapper = import_attribute(stored['mapper'])() if stored['mapper'] else None
+    return configuration, worker, mapper
+
+
+def create_envelope(plugin_name, source, conf_hash, command, entity_type, task_id, worker, parts, res_dict, pkg_dict):
+    """
+    Creates the envelope for a command, which is either a function, a method of the WorkerWrapper of the plugin (which
+    the worker creates itself) or a method of a (picklable) command object carrying its own parameters (of which the
+    `worker` is left out as well)
+    """
+    instance = getattr(command, '__self__', None)
+    if instance is worker:
+        instance = None
+    elif getattr(instance, 'worker', None) is worker:
+        instance = copy.copy(instance)
+        instance.worker = None
+    return {
+        'version': ENVELOPE_VERSION,
+        'plugin': plugin_name,
+        'source': source,
+        'configuration': conf_hash,
+        'command': command.__name__ if getattr(command, '__self__', None) is not None
+        else '{}.{}'.format(command.__module__, command.__name__),
+        'instance': instance,
+        'on_worker': instance is None and getattr(command, '__self__', None) is not None,
+        'parts': list(parts),
+        'entity_type': entity_type,
+        'package_id': pkg_dict.get('id'),
+        'resource_id': res_dict.get('id') if entity_type == 'resource' else None,
+        'metadata_modified': pkg_dict.get('metadata_modified'),
+        'task_id': task_id
+    }
+
+
+def resolve_job_data(configuration, envelope, remote, mapper=None):
+    """
+    Retrieves the same data `ckanext.tracker_base.helpers.get_data` would have put in the job from the source CKAN
+    """
+    parts = envelope['parts']
+    pkg_dict = remote.call('package_show', {'id': envelope['package_id']})
+    if pkg_dict is None:
+        raise LookupError("package {} could not be found".format(envelope['package_id']))
+    if (pkg_dict.get('metadata_modified') or '') < (envelope['metadata_modified'] or ''):
+        log.warning("package {} is older than when the job was created".format(envelope['package_id']))
+    resources = {res.get('id'): res for res in pkg_dict.pop('resources', [])}
+
+    package = None
+    resource = None
+    data_dictionary = None
+    if envelope['entity_type'] == 'resource':
+        resource_id = envelope['resource_id']
+        res_dict = resources.get(resource_id) or remote.call('resource_show', {'id': resource_id})
+        if res_dict is None:
+            raise LookupError("resource {} could not be found".format(resource_id))
+        if 'resource' in parts:
+            if mapper is not None:
+                resource = mapper.map_resource_to_harmonized(configuration, res_dict)
+            else:
+                resource = Resource.from_dict(res_dict)
+        if 'data_dictionary' in parts and res_dict.get('datastore_active', False):
+            data_dictionary = DataDictionary.from_dict(
+                remote.call('datastore_search', {'id': resource_id, 'limit': 0}))
+        else:
+            data_dictionary = DataDictionary.from_dict(None)
+    if 'package' in parts:
+        pkg_dict['license_url'] = None
+        if 'license' in parts:
+            pkg_dict['license_url'] = next((license.get('url', None) for license in remote.call('license_list', {}) or []
+                                            if license["id"] == pkg_dict.get('license_id', None)), None)
+        organization_data = None
+        organization_id = (pkg_dict.get('organization') or {}).get('id', None)
+        if 'organization' in parts and organization_id is not None:
+            organization_data = remote.call('organization_show', {'id': organization_id})
+        if not pkg_dict.get('organization', None):
+            pkg_dict['organization'] = dict()
+        for field in GEONETWORK_ORGANIZATION_FIELDS:
+            pkg_dict['organization'][field] = organization_data.get(field, None) if organization_data else None
+        if mapper is not None:
+            package = mapper.map_package_to_harmonized(configuration, pkg_dict)
+        else:
+            package = Package.from_dict(pkg_dict)
+
+    if envelope['entity_type'] == 'package':
+        return configuration, package
+    return configuration, package, resource, data_dictionary
+
+
+def execute(envelope):
+    """
+    Entry point of a compact job on the worker side: resolves the configuration and data and runs the actual command
+    """
+    if envelope.get('version') != ENVELOPE_VERSION:
+        raise ValueError("unsupported envelope version {}".format(envelope.get('version')))
+    configuration, worker, mapper = load_configuration(get_current_connection(), envelope)
+    args = resolve_job_data(configuration, envelope, RemoteCkan(configuration), mapper)
+    instance = envelope['instance']
+    if instance is not None:
+        if getattr(instance, 'worker', False) is None:
+            instance.worker = worker
+        command = getattr(instance, envelope['command'])
+    elif envelope['on_worker']:
+        command = getattr(worker, envelope['command'])
+    else:
+        command = import_attribute(envelope['command'])
+    return command(*args)
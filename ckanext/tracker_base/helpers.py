@@ -1,14 +1,27 @@
 import re
+import datetime
+import json
 from redis import Redis
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 from domain import Package, Resource, DataDictionary
-from sqlalchemy import and_
+from sqlalchemy import and_, bindparam
 from ckan.model import task_status_table
+from ckan.model.types import make_uuid
 from domain.task_status import DomainTaskStatus
 from typing import Dict, Optional, List
 from ckan.model import State
+from ckanext.tracker_base.cache import TTLCache
+from ckanext.tracker_base.envelope import GEONETWORK_ORGANIZATION_FIELDS
+from ckanext.tracker_base import job_table, pool
+
+# Process local caches for data which is the same for a lot of jobs, see `configure_caches`
+LICENSE_CACHE = TTLCache('licenses', maxsize=1)
+ORGANIZATION_CACHE = TTLCache('organizations', maxsize=1024)
+
+# The parts of the job data a worker can ask for (see `get_data` and `BaseTrackerPlugin.get_job_data_parts`)
+JOB_DATA_PARTS = ['package', 'resource', 'data_dictionary', 'license', 'organization']
 
 def set_connection():
     """
@@ -245,32 +258,70 @@ def get_configuration_dict(name):
     return conf_dict
 
 
-def get_package_data(context, configuration, mapper, pkg_dict):
+def configure_caches():
+    """
+    Sets the time to live (in seconds) of the license and organization caches and the size of the pool of REST clients
+    """
+    LICENSE_CACHE.ttl = int(toolkit.config.get('ckanext.tracker.cache.license_ttl', 3600))
+    ORGANIZATION_CACHE.ttl = int(toolkit.config.get('ckanext.tracker.cache.organization_ttl', 300))
+    pool.configure(toolkit.config)
+
+
+def get_license_index(context):
+    """
+    Returns a (cached) dict containing the URL for every license id
+    """
+    def create():
+        license_list = get_action_data('license_list', context, {})
+        if license_list is None:
+            return None
+        return {license["id"]: license.get('url', None) for license in license_list}
+    return LICENSE_CACHE.get_or_set('licenses', create) or {}
+
+
+def get_organization_geonetwork(context, organization_id):
+    """
+    Returns a (cached) dict containing the GeoNetwork URL and credentials of an organization or None if the organization
+    could not be found
+    """
+    if organization_id is None:
+        return None
+
+    def create():
+        organization_data = get_action_data('organization_show', context, {'id': organization_id})
+        if organization_data is None:
+            return None
+        return {field: organization_data.get(field, None) for field in GEONETWORK_ORGANIZATION_FIELDS}
+    return ORGANIZATION_CACHE.get_or_set(organization_id, create)
+
+
+def invalidate_organization(organization_id):
+    ORGANIZATION_CACHE.invalidate(organization_id)
+
+
+def get_package_data(context, configuration, mapper, pkg_dict, parts=None):
     """
     Ugly method for getting the package data from a package_show and adding information from the organization. If a
-    mapper is given will map to harmonized
+    mapper is given will map to harmonized. The license and organization information is only retrieved when these
+    parts are requested (None meaning all parts)
     """
-    license_list = get_action_data('license_list', context, {})
-    # Get the first element from the licence list, that matches the license ID and return it's URL
-    pkg_dict['license_url'] = next((license.get('url', None) for license in license_list if
-                                    license["id"] == pkg_dict.get('license_id', None)), None)
+    if parts is None:
+        parts = JOB_DATA_PARTS
+    # Get the URL of the license matching the license ID
+    pkg_dict['license_url'] = None
+    if 'license' in parts:
+        pkg_dict['license_url'] = get_license_index(context).get(pkg_dict.get('license_id', None))
     # Get the organization with GeoNetwork URL and credentials
     if pkg_dict is not None:
-        organization_data = get_action_data('organization_show',
-                                            context,
-                                            {'id': pkg_dict.get('organization', {}).get('id', None)}
-                                            )
-        if organization_data is not None:
-            # Include the GeoNetwork URL and credentials in the organization in the package
-            pkg_dict['organization']['geonetwork_url'] = organization_data.get('geonetwork_url', None)
-            pkg_dict['organization']['geonetwork_password'] = organization_data.get('geonetwork_password', None)
-            pkg_dict['organization']['geonetwork_username'] = organization_data.get('geonetwork_username', None)
-        else:
-            if not pkg_dict.get('organization', None):
-                pkg_dict['organization'] = dict()
-            pkg_dict['organization']['geonetwork_url'] = None
-            pkg_dict['organization']['geonetwork_password'] = None
-            pkg_dict['organization']['geonetwork_username'] = None
+        organization_data = None
+        if 'organization' in parts:
+            organization_data = get_organization_geonetwork(
+                context, (pkg_dict.get('organization') or {}).get('id', None))
+        if not pkg_dict.get('organization', None):
+            pkg_dict['organization'] = dict()
+        # Include the GeoNetwork URL and credentials in the organization in the package
+        for field in GEONETWORK_ORGANIZATION_FIELDS:
+            pkg_dict['organization'][field] = organization_data.get(field, None) if organization_data else None
     if mapper is not None:
         result = mapper.map_package_to_harmonized(configuration, pkg_dict)
     else:
@@ -295,11 +346,15 @@ def get_datadictionary_data(context, resource_id):
     return DataDictionary.from_dict(data_dict)
 
 
-def get_data(context, configuration, entity_type, task_id, mapper, res_dict, pkg_dict):
+def get_data(context, configuration, entity_type, task_id, mapper, res_dict, pkg_dict, parts=None):
     """
-    This method will create all the data necessary for the Job and worker commands
+    This method will create all the data necessary for the Job and worker commands. Only the requested parts (see
+    `JOB_DATA_PARTS`, None meaning all parts) are build, the other parts will be None. The data dictionary is never
+    looked up for resources which are not in the datastore as that lookup is bound to fail
     TODO document better params and return options
     """
+    if parts is None:
+        parts = JOB_DATA_PARTS
     package = None
     resource = None
     data_dictionary = None
@@ -307,10 +362,14 @@ def get_data(context, configuration, entity_type, task_id, mapper, res_dict, pkg
 
     # Configuration data
     if res_dict is not None and entity_type == 'resource':
-        resource = get_resource_data(context, configuration, mapper, res_dict)
-        data_dictionary = get_datadictionary_data(context, resource.resource_id)
-    if pkg_dict is not None:
-        package = get_package_data(context, configuration, mapper, pkg_dict)
+        if 'resource' in parts:
+            resource = get_resource_data(context, configuration, mapper, res_dict)
+        if 'data_dictionary' in parts and res_dict.get('datastore_active', False):
+            data_dictionary = get_datadictionary_data(context, res_dict.get('id'))
+        else:
+            data_dictionary = DataDictionary.from_dict(None)
+    if pkg_dict is not None and 'package' in parts:
+        package = get_package_data(context, configuration, mapper, pkg_dict, parts)
 
     # the package commands of the worker require a different set of data then the resource/datastore commands
     if entity_type == 'package':
@@ -325,18 +384,111 @@ def get_data(context, configuration, entity_type, task_id, mapper, res_dict, pkg
 # resource/plugin combination a TaskStatus which contains information about the current task being pending or
 # executed (so no trail).
 
-# Create a TaskStatus when none exist yet with the default value properties `job_id` and `job_command`
-def create_task(context, job, task_type, entity_type, res_dict, pkg_dict):
-    task = DomainTaskStatus(
+# Create a (not yet stored) TaskStatus with the default value properties `job_id` and `job_command`
+def new_task(job, task_type, entity_type, res_dict, pkg_dict, action=None):
+    return DomainTaskStatus(
         entity_id=res_dict.get("id") if entity_type == 'resource' else pkg_dict.get("id"),
         entity_type=entity_type,
         task_type=task_type,
-        key=job.id, action=job.func_name
+        key=job.id, action=action or job.func_name
     )
+
+
+# Create a TaskStatus when none exist yet with the default value properties `job_id` and `job_command`
+def create_task(context, job, task_type, entity_type, res_dict, pkg_dict):
+    task = new_task(job, task_type, entity_type, res_dict, pkg_dict)
     created_task_dict = get_action_data("task_status_update", context, task.to_dict())
     return DomainTaskStatus.from_dict(created_task_dict)
 
 
+def _task_status_row(task):
+    """
+    Converts a DomainTaskStatus into a row of the task_status table
+    """
+    task_dict = task.to_dict()
+    row = {column.name: task_dict.get(column.name) for column in task_status_table.c}
+    row['id'] = row['id'] or make_uuid()
+    row['last_updated'] = datetime.datetime.now()
+    if isinstance(row['value'], (dict, list)):
+        row['value'] = json.dumps(row['value'])
+    return row
+
+
+# Bulk versions of `create_task` and `update_task` which bypass the `task_status_update` action (and with that the
+# validation and a commit per TaskStatus) to store all TaskStatus objects of a batch of jobs using a single statement
+def create_tasks(context, tasks):
+    if not tasks:
+        return []
+    rows = [_task_status_row(task) for task in tasks]
+    session = context['session']
+    session.execute(task_status_table.insert(), rows)
+    created_tasks = [DomainTaskStatus.from_dict(dict(row, last_updated=row['last_updated'].isoformat())) for row in rows]
+    if job_table.is_written():
+        job_table.insert_jobs(session, created_tasks)
+    if not context.get('defer_commit'):
+        session.commit()
+    return created_tasks
+
+
+def update_tasks(context, tasks):
+    if not tasks:
+        return
+    rows = [_task_status_row(task) for task in tasks]
+    session = context['session']
+    session.execute(
+        task_status_table.update().where(
+            task_status_table.c.id == bindparam('b_id')
+        ).values(
+            state=bindparam('b_state'),
+            value=bindparam('b_value'),
+            error=bindparam('b_error'),
+            last_updated=bindparam('b_last_updated')
+        ),
+        [{'b_{}'.format(key): row[key] for key in ['id', 'state', 'value', 'error', 'last_updated']} for row in rows]
+    )
+    if job_table.is_written():
+        job_table.update_jobs(session, tasks)
+    if not context.get('defer_commit'):
+        session.commit()
+
+
+def show_tasks(context, task_ids):
+    """
+    Returns the TaskStatus objects for the given ids (by id) using a single statement
+    """
+    if not task_ids:
+        return {}
+    rows = context['session'].execute(
+        task_status_table.select().where(task_status_table.c.id.in_(list(task_ids)))
+    ).fetchall()
+    return {row['id']: task_from_row(row) for row in rows}
+
+
+def task_from_row(row):
+    """
+    Converts a row of the task_status table (like `TaskStatus.as_dict`) into a DomainTaskStatus
+    """
+    task_dict = dict(row.items())
+    if isinstance(task_dict.get('last_updated'), datetime.datetime):
+        task_dict['last_updated'] = task_dict['last_updated'].isoformat()
+    return DomainTaskStatus.from_dict(task_dict)
+
+
+def get_task_status(task_dict):
+    """
+    Returns the stored TaskStatus a `task_status_update` is about to change, which is identified either by its id or by
+    the combination of entity_id, task_type and key (just like that action does). When identified by its id the row is
+    loaded into the session the same way that action loads it, so it is only read once
+    """
+    if task_dict.get('id'):
+        return model.TaskStatus.get(task_dict['id'])
+    return model.Session.query(model.TaskStatus).filter_by(
+        entity_id=task_dict.get('entity_id'),
+        task_type=task_dict.get('task_type'),
+        key=task_dict.get('key')
+    ).first()
+
+
 # Update a TaskStatus identified by task_id with a state (required), value properties and error message (optional).
 # The value is a JSON stored as a string, which why the json module is involved in updating that field
 def update_task(context, task, state, remote_id=None, error=None):
@@ -363,3 +515,5 @@ def purge_task_statuses(connection, entity_id, entity_type, task_type):
             )
         )
     )
+    if job_table.is_written():
+        job_table.delete_jobs(connection, entity_id, entity_type, task_type)
@@ -0,0 +1,222 @@
+"""
+Dedicated table holding the history of the jobs of the trackers using typed columns, so reading it (badges, status
+panels, streams) does not involve the JSON `value` of the TaskStatus table.
+
+The workers keep reporting their progress using the `task_status_*` actions, so the TaskStatus table stays the
+source of truth: every TaskStatus of a job is mirrored into this table when it is written (see `create_tasks`,
+`update_tasks` and the chained `task_status_update` of `PackageResourceTrackerPlugin`).
+
+- `ckanext.tracker.job_table = off` (default): the table is not used
+- `ckanext.tracker.job_table = write`: the table is kept up to date (e.g. to fill it before switching to `on`)
+- `ckanext.tracker.job_table = on`: the table is kept up to date and used for reading
+"""
+import datetime
+import hashlib
+import logging
+
+from ckan import model
+from ckan.model import meta
+from ckan.plugins import toolkit
+from domain.task_status import ERROR, COMPLETE
+from ckanext.tracker_base.coalesce import SUPERSEDED
+from sqlalchemy import Column, DateTime, Index, Table, UnicodeText, and_, bindparam, func, or_, select
+
+log = logging.getLogger(__name__)
+
+JOB_TABLE_OFF = 'off'
+JOB_TABLE_WRITE = 'write'
+JOB_TABLE_ON = 'on'
+
+tracker_job_table = Table(
+    'tracker_job', meta.metadata,
+    # same id as the TaskStatus of the job
+    Column('id', UnicodeText, primary_key=True),
+    Column('job_id', UnicodeText, nullable=False),
+    Column('entity_id', UnicodeText, nullable=False),
+    Column('entity_type', UnicodeText, nullable=False),
+    Column('task_type', UnicodeText, nullable=False),
+    Column('action', UnicodeText),
+    Column('state', UnicodeText),
+    Column('error', UnicodeText),
+    Column('remote_id', UnicodeText),
+    Column('created', DateTime),
+    Column('pending', DateTime),
+    Column('running', DateTime),
+    Column('complete', DateTime),
+    Column('last_updated', DateTime, nullable=False),
+    Index('idx_tracker_job_entity', 'entity_id', 'entity_type', 'task_type', 'last_updated'),
+    Index('idx_tracker_job_job_id', 'job_id')
+)
+
+COLUMNS = [column.name for column in tracker_job_table.c]
+
+UPDATED_COLUMNS = ['state', 'error', 'remote_id', 'pending', 'running', 'complete', 'last_updated']
+
+
+class TrackerJob(object):
+    """
+    Read-only counterpart of DomainTaskStatus based on a row of the tracker_job table (providing everything the
+    templates and the stream use)
+    """
+
+    def __init__(self, row):
+        for column in COLUMNS:
+            setattr(self, column, row[column])
+
+    def hash(self):
+        return hashlib.md5(self.id.encode('utf-8')).hexdigest()
+
+    def get_state(self, timestamp):
+        if self.complete is not None and timestamp >= self.complete:
+            return self.state if self.state in [ERROR, COMPLETE, SUPERSEDED] else COMPLETE
+        if self.running is not None and timestamp >= self.running:
+            return 'running'
+        if self.pending is not None and timestamp >= self.pending:
+            return 'pending'
+        return 'created'
+
+    def as_dict(self):
+        result = dict((column, getattr(self, column)) for column in COLUMNS)
+        for column in ['created', 'pending', 'running', 'complete', 'last_updated']:
+            if result[column] is not None:
+                result[column] = result[column].isoformat()
+        return result
+
+
+def get_mode():
+    return toolkit.config.get('ckanext.tracker.job_table', JOB_TABLE_OFF)
+
+
+def is_written():
+    return get_mode() in [JOB_TABLE_WRITE, JOB_TABLE_ON]
+
+
+def is_read():
+    return get_mode() == JOB_TABLE_ON
+
+
+def create_table():
+    tracker_job_table.create(bind=meta.engine, checkfirst=True)
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def _row(task, last_updated=None):
+    """
+    Converts a DomainTaskStatus into a row of the tracker_job table
+    """
+    return {
+        'id': task.id,
+        'job_id': task.job_id,
+        'entity_id': task.entity_id,
+        'entity_type': task.entity_type,
+        'task_type': task.task_type,
+        'action': task.action,
+        'state': task.state,
+        'error': task.error,
+        'remote_id': getattr(task, 'remote_id', None),
+        'created': _timestamp(task.created),
+        'pending': _timestamp(task.pending),
+        'running': _timestamp(task.running),
+        'complete': _timestamp(task.complete),
+        'last_updated': last_updated or _timestamp(task.last_updated) or datetime.datetime.now()
+    }
+
+
+def insert_jobs(session, tasks):
+    """
+    Inserts the jobs of the given DomainTaskStatus objects using a single statement (without committing)
+    """
+    if tasks:
+        session.execute(tracker_job_table.insert(), [_row(task) for task in tasks])
+
+
+def update_jobs(session, tasks):
+    """
+    Updates the state of the jobs of the given DomainTaskStatus objects using a single statement (without committing)
+    """
+    if not tasks:
+        return
+    now = datetime.datetime.now()
+    session.execute(
+        tracker_job_table.update().where(
+            tracker_job_table.c.id == bindparam('b_id')
+        ).values(**dict((column, bindparam('b_' + column)) for column in UPDATED_COLUMNS)),
+        [dict(('b_' + key, value) for key, value in _row(task, now).items() if key in ['id'] + UPDATED_COLUMNS)
+         for task in tasks]
+    )
+
+
+def save_job(session, task):
+    """
+    Inserts or updates the job of a DomainTaskStatus (e.g. when a worker reports its progress)
+    """
+    if session.execute(select([tracker_job_table.c.id]).where(tracker_job_table.c.id == task.id)).scalar():
+        update_jobs(session, [task])
+    else:
+        insert_jobs(session, [task])
+
+
+def delete_jobs(connection, entity_id, entity_type, task_type):
+    connection.execute(
+        tracker_job_table.delete().where(
+            and_(
+                tracker_job_table.c.entity_id == entity_id,
+                tracker_job_table.c.entity_type == entity_type,
+                tracker_job_table.c.task_type == task_type
+            )
+        )
+    )
+
+
+def select_latest(entity_type, entity_ids, tracker_names):
+    """
+    Returns the unfinished jobs and the last finished job per entity and tracker (newest first) using a single query,
+    see `ckanext.tracker.helpers.get_latest_task_statuses`
+    """
+    finished = tracker_job_table.c.state.in_([ERROR, COMPLETE])
+    ranked = select(list(tracker_job_table.c) + [
+        func.row_number().over(
+            partition_by=[tracker_job_table.c.entity_id, tracker_job_table.c.task_type, finished],
+            order_by=tracker_job_table.c.last_updated.desc()
+        ).label('row_number')
+    ]).where(
+        and_(
+            tracker_job_table.c.entity_id.in_(entity_ids),
+            tracker_job_table.c.entity_type == entity_type,
+            tracker_job_table.c.task_type.in_(tracker_names),
+            tracker_job_table.c.state != SUPERSEDED
+        )
+    ).alias('ranked')
+    rows = model.Session.execute(
+        select([column for column in ranked.c if column.name != 'row_number']).where(
+            or_(
+                ranked.c.state.notin_([ERROR, COMPLETE]),
+                ranked.c.row_number == 1
+            )
+        ).order_by(ranked.c.last_updated.desc())
+    ).fetchall()
+    return [TrackerJob(row) for row in rows]
+
+
+def select_jobs(entity_type, entity_id, tracker_names, limit):
+    """
+    Returns the last `limit` jobs of an entity (sorted by created), see `ckanext.tracker.helpers.get_tracker_activities`
+    """
+    rows = model.Session.execute(
+        select([tracker_job_table]).where(
+            and_(
+                tracker_job_table.c.entity_id == entity_id,
+                tracker_job_table.c.entity_type == entity_type,
+                tracker_job_table.c.task_type.in_(tracker_names)
+            )
+        ).order_by(tracker_job_table.c.last_updated.desc()).limit(limit)
+    ).fetchall()
+    return sorted([TrackerJob(row) for row in rows], key=lambda job: job.created)
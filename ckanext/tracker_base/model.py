@@ -14,3 +14,31 @@ class TrackerBackendModel:
         if isinstance(other, TrackerBackendModel):
             return self.name == other.name
         return False
+
+
+class PlannedJob:
+    """
+    This is a simple model holding everything needed to put a job for a BaseTrackerPlugin instance on its queue. The job
+    and task are filled in once the job is submitted (see `submit_jobs`), the data of a job without a compact payload
+    once it is prepared (see `prepare_jobs`)
+    """
+
+    def __init__(self, tracker, entity_type, command, res_dict, pkg_dict, compact=True, coalesce=True):
+        self.tracker = tracker
+        self.entity_type = entity_type
+        self.command = command
+        self.res_dict = res_dict
+        self.pkg_dict = pkg_dict
+        self.compact = compact
+        self.coalesce = coalesce
+        self.data = None
+        self.job = None
+        self.task = None
+
+    def action(self):
+        return self.command.__name__
+
+    def entity_id(self):
+        if self.entity_type == 'resource':
+            return self.res_dict.get("id")
+        return self.pkg_dict.get("id")
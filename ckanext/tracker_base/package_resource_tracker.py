@@ -1,7 +1,10 @@
 from ckan import model
 import ckanext.tracker_base.helpers as base_helpers
-from ckanext.tracker_base.context import TrackerContext
+from ckanext.tracker_base.context import TrackerContext, BASE_SNAPSHOT_FIELDS, register_snapshot_fields
 from ckanext.tracker_base.base_tracker import BaseTrackerPlugin
+from ckanext.tracker_base.dispatch import dispatch_jobs
+from ckanext.tracker_base import job_table, stats
+from domain.task_status import DomainTaskStatus
 import logging
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
@@ -27,6 +30,23 @@ class PackageResourceTrackerPlugin(BaseTrackerPlugin):
     include_package_fields = None   # type: list
     exclude_package_fields = None   # type: list
 
+    # IConfigurable
+    def configure(self, config):
+        super(PackageResourceTrackerPlugin, self).configure(config)
+        register_snapshot_fields(*self.get_snapshot_fields())
+
+    def get_snapshot_fields(self):
+        """
+        Returns the package and resource fields this tracker compares (None meaning all fields)
+        """
+        package_fields = self.include_package_fields
+        if self.ignore_packages and self.separate_tracking:
+            package_fields = BASE_SNAPSHOT_FIELDS
+        resource_fields = self.include_resource_fields
+        if self.ignore_resources and self.separate_tracking:
+            resource_fields = BASE_SNAPSHOT_FIELDS
+        return package_fields, resource_fields
+
     def _action(self, type):
 
         @toolkit.chained_action
@@ -34,15 +54,22 @@ class PackageResourceTrackerPlugin(BaseTrackerPlugin):
             if 'tracker' not in context:
                 package_id = data_dict.get("id", None) if type == 'package' else data_dict.get("package_id", None)
                 context['tracker'] = TrackerContext(package_id)
+            # every tracker chaining this action shares the snapshots taken by the outermost one
+            context['tracker'].register(self)
             context['tracker'].enter()
             try:
                 result = original_action(context, data_dict)
                 context['tracker'].exit()
                 if context['tracker'].level():
+                    tracker_context = context['tracker']  # type: TrackerContext
                     package_id = result.get("id", None) if type == 'package' else result.get("package_id", None)
-                    context['tracker'].after(package_id)
-                    self.determine_actions_based_on_context(context)
+                    tracker_context.after(package_id)
+                    for tracker in tracker_context.trackers():
+                        tracker.determine_actions_based_on_context(context)
+                    log.debug('{} tracker(s) shared {} package_show call(s)'.format(
+                        len(tracker_context.trackers()), tracker_context.show_count()))
                     del context['tracker']
+                    dispatch_jobs(context, tracker_context.jobs())
                 return result
             except Exception as e:
                 context['tracker'].exit()
@@ -57,14 +84,50 @@ class PackageResourceTrackerPlugin(BaseTrackerPlugin):
         functions = ['create', 'patch', 'update', 'delete']
         actions = {"{}_{}".format(t, f): self._action(t) for t in types for f in functions}
         actions['package_revise'] = self._action('package')
+        actions['task_status_update'] = self._task_status_update_action()
         return actions
 
+    def _task_status_update_action(self):
+
+        @toolkit.chained_action
+        def _chained_action(original_action, context, data_dict):
+            # only the feedback of the jobs of this tracker is counted (see `ckanext.tracker_base.stats`) and mirrored
+            # (see `ckanext.tracker_base.job_table`)
+            if data_dict.get('task_type') != self.name:
+                return original_action(context, data_dict)
+            task_status = base_helpers.get_task_status(data_dict)
+            old_state = task_status.state if task_status is not None else None
+            result = original_action(context, data_dict)
+            if task_status is not None:
+                # the action saved the TaskStatus using a session of its own
+                model.Session.expire(task_status)
+            try:
+                stats.transition(self.get_connection(), self.get_queue_name(), self.name, old_state,
+                                 result.get('state'))
+            except Exception as unexpected_error:
+                log.error("{}: could not update the job counters: {}".format(self.name, unexpected_error))
+            if job_table.is_written() and result.get('key') != self.name:
+                session = context.get('session', model.Session)
+                # a failure should not abort the transaction of the caller, which only commits it itself when it
+                # asked to defer the commit
+                savepoint = session.begin_nested()
+                try:
+                    job_table.save_job(session, DomainTaskStatus.from_dict(result))
+                    savepoint.commit()
+                except Exception as unexpected_error:
+                    savepoint.rollback()
+                    log.error("{}: could not update the job table: {}".format(self.name, unexpected_error))
+                if not context.get('defer_commit'):
+                    session.commit()
+            return result
+
+        return _chained_action
+
     def determine_actions_based_on_context(self, context):
         tracker_context = context['tracker']  # type: TrackerContext
         if tracker_context is None:
             log.warning("Could not determine any tracker context")
             return
-        pkg_dict = tracker_context.after_package()
         before_package = tracker_context.before_package()
         before_resources = {}
         if before_package is not None:
@@ -91,6 +154,17 @@ class PackageResourceTrackerPlugin(BaseTrackerPlugin):
             if res_changes:
                 changes_resources[res_id] = res_changes
 
+        if tracker_context.is_partial() and after_package is not None:
+            if before_package is not None and not \
+                    (changes_package or created_resources or deleted_resources or changes_resources):
+                log.debug("{}: nothing changed so nothing to do".format(self.name))
+                return
+            # the lightweight snapshot only contains the compared fields, the jobs need the complete package
+            after_package = tracker_context.package_dict()
+            after_resources = {res.get("id"): res for res in after_package.pop("resources", [])}
+        # the jobs get their own copy of the package, still containing its resources
+        pkg_dict = tracker_context.package_dict() if after_package is not None else None
+
         if before_package is None and after_package is not None:
             # create package
             if not self.ignore_packages:
@@ -137,7 +211,8 @@ class PackageResourceTrackerPlugin(BaseTrackerPlugin):
         a first setup for a resource/package_purge has been implemented
         """
         super(PackageResourceTrackerPlugin, self).after_delete(mapper, connection, instance)
-        context = {'model': model, 'session': model.Session, 'user': toolkit.g.user}
+        # the entity will be gone by the time the job runs, so the job can't refer to it (see `use_compact_payload`)
+        context = {'model': model, 'session': model.Session, 'user': toolkit.g.user, 'tracker_full_payload': True}
         if mapper.entity == model.Resource and not self.ignore_resources:
                 pkg_dict = instance['package'].as_dict()
                 res_dict = instance.as_dict()
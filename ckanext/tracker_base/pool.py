@@ -0,0 +1,72 @@
+"""
+Process wide pool of REST clients (e.g. `GeoServerRestApi`, `GeoNetworkRestApi`) keyed by the class, base URL and
+credentials of the client. Reusing the clients reuses their HTTP sessions (and with that the kept alive connections)
+instead of paying the TCP/TLS setup for every lookup. As the clients (and their sessions) aren't thread safe every thread
+gets clients of its own. The pool is bounded and clients which haven't been used for a while are evicted (closing their
+sessions):
+
+- `ckanext.tracker.cache.client_pool_size` (default: `32`)
+- `ckanext.tracker.cache.client_idle_timeout` (default: `300` seconds)
+
+This module is also used by the workers, so it should not depend on CKAN itself.
+"""
+import hashlib
+import logging
+import threading
+
+from ckanext.tracker_base.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+def close_client(client):
+    """
+    Closes the HTTP session (and with that the kept alive connections) of a client which is removed from the pool
+    """
+    session = getattr(client, 'session', None)
+    if session is not None:
+        try:
+            session.close()
+        except Exception as unexpected_error:
+            log.debug("could not close the session of {}: {}".format(type(client).__name__, unexpected_error))
+
+
+CLIENT_POOL = TTLCache('rest_clients', maxsize=32, ttl=300, sliding=True, on_evict=close_client)
+
+
+def configure(config):
+    CLIENT_POOL.maxsize = int(config.get('ckanext.tracker.cache.client_pool_size', 32))
+    CLIENT_POOL.ttl = int(config.get('ckanext.tracker.cache.client_idle_timeout', 300))
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return u'{}'.format(value).encode('utf-8')
+
+
+def get_key(client_class, url, credentials):
+    # the credentials are part of the key, but aren't kept in it
+    digest = hashlib.sha1(b'\0'.join(_to_bytes(credential or b'') for credential in credentials))
+    return '{}.{}'.format(client_class.__module__, client_class.__name__), url, digest.hexdigest(), \
+        threading.current_thread().ident
+
+
+def get_client(client_class, url, credentials, *args):
+    """
+    Returns the pooled client of the current thread for the URL and credentials, creating it using `client_class(*args)` when there is none
+    """
+    return CLIENT_POOL.get_or_set(get_key(client_class, url, credentials), lambda: client_class(*args))
+
+
+def get_geoserver_api(configuration):
+    from worker.geoserver.rest import GeoServerRestApi
+    return get_client(GeoServerRestApi, configuration.geoserver_url,
+                      [getattr(configuration, 'geoserver_username', None),
+                       getattr(configuration, 'geoserver_password', None)], configuration)
+
+
+def get_geonetwork_api(organization):
+    from worker.geonetwork.rest import GeoNetworkRestApi
+    return get_client(GeoNetworkRestApi, organization.geonetwork_url,
+                      [organization.geonetwork_username, organization.geonetwork_password], organization)
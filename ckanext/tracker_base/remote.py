@@ -0,0 +1,49 @@
+import logging
+
+import requests
+from domain.task_status import DomainTaskStatus
+
+log = logging.getLogger(__name__)
+
+
+class RemoteCkan(object):
+    """
+    Minimal client for the action API of the source CKAN instance of a Configuration, to be used on the worker side
+    (where the CKAN actions can't be called directly). Mimics `get_action_data` by returning None on any error
+    """
+
+    def __init__(self, configuration, session=None):
+        self.url = '{}/api/3/action/'.format((configuration.source_ckan_host or '').rstrip('/'))
+        self.api_key = configuration.source_user_api_key
+        self.session = session or requests.Session()
+
+    def call(self, action, data_dict):
+        headers = {'Authorization': self.api_key} if self.api_key else {}
+        try:
+            response = self.session.post(self.url + action, json=data_dict, headers=headers)
+            body = response.json()
+        except (requests.RequestException, ValueError) as error:
+            log.error("calling {} on {} failed: {}".format(action, self.url, error))
+            return None
+        if not body.get('success', False):
+            log.debug("calling {} on {} was not successful: {}".format(action, self.url, body.get('error')))
+            return None
+        return body.get('result')
+
+
+def update_task(configuration, state, error=None):
+    """
+    Updates the state of the TaskStatus of the job (`configuration.task_status_id`) on the worker side, for commands
+    which don't leave that to the workers themselves
+    """
+    task_status_id = getattr(configuration, 'task_status_id', None)
+    if task_status_id is None:
+        return None
+    remote = RemoteCkan(configuration)
+    task_dict = remote.call('task_status_show', {'id': task_status_id})
+    if task_dict is None:
+        log.warning("TaskStatus {} could not be found".format(task_status_id))
+        return None
+    task = DomainTaskStatus.from_dict(task_dict)
+    task.set_state(state, None, error)
+    return remote.call('task_status_update', task.to_dict())
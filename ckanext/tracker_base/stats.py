@@ -0,0 +1,87 @@
+"""
+Counters of the jobs per queue, plugin and status kept in Redis (one hash per queue) so the state of the queues can be
+shown without loading every job. The counters are updated when jobs are put on the queue (see `submit_jobs`) and when
+the workers report the state of their TaskStatus (see `PackageResourceTrackerPlugin`), they can be corrected using
+`ckanext.tracker.helpers.reconcile_tracker_queues`
+"""
+from domain.task_status import PENDING, ERROR
+
+STATS_KEY = 'ckanext-tracker:stats:{queue}'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FAILED = 'failed'
+STATUSES = [QUEUED, RUNNING, FAILED]
+
+# the state of a TaskStatus and the counter it belongs to (a COMPLETE job isn't counted)
+STATE_MAPPING = {
+    PENDING: QUEUED,
+    'running': RUNNING,
+    ERROR: FAILED
+}
+
+
+def get_key(queue):
+    return STATS_KEY.format(queue=queue)
+
+
+def get_field(plugin_name, status):
+    return '{}:{}'.format(plugin_name, status)
+
+
+def increment(connection, queue, plugin_name, status, amount=1):
+    """
+    Changes a counter, the connection can also be a pipeline
+    """
+    connection.hincrby(get_key(queue), get_field(plugin_name, status), amount)
+
+
+def transition(connection, queue, plugin_name, old_state, new_state):
+    """
+    Moves a job from the counter belonging to the old state of its TaskStatus to the one belonging to the new state
+    """
+    old_status = STATE_MAPPING.get(old_state)
+    new_status = STATE_MAPPING.get(new_state)
+    if old_status == new_status:
+        return
+    pipeline = connection.pipeline()
+    if old_status is not None:
+        increment(pipeline, queue, plugin_name, old_status, -1)
+    if new_status is not None:
+        increment(pipeline, queue, plugin_name, new_status, 1)
+    pipeline.execute()
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def read(connection, queues):
+    """
+    Returns the counters of all queues ({queue: {plugin: {status: count}}}) using a single round trip
+    """
+    pipeline = connection.pipeline()
+    for queue in queues:
+        pipeline.hgetall(get_key(queue))
+    result = {}
+    for queue, counters in zip(queues, pipeline.execute()):
+        result[queue] = {}
+        for field, value in counters.items():
+            plugin_name, _, status = _decode(field).rpartition(':')
+            # updates for the same job can arrive out of order, which could make a counter drop below zero for a while
+            result[queue].setdefault(plugin_name, {})[status] = max(0, int(value))
+    return result
+
+
+def replace(connection, queue, counters):
+    """
+    Replaces all counters of a queue ({plugin: {status: count}})
+    """
+    pipeline = connection.pipeline()
+    pipeline.delete(get_key(queue))
+    for plugin_name, statuses in counters.items():
+        for status, count in statuses.items():
+            pipeline.hset(get_key(queue), get_field(plugin_name, status), count)
+    pipeline.execute()
@@ -1,8 +1,10 @@
 import re
 import urlparse
+from collections import namedtuple
 
+from ckanext.tracker_base.envelope import GEONETWORK_ORGANIZATION_FIELDS
 from ckanext.tracker_base.helpers import link_is_enabled
-from worker.geonetwork.rest import GeoNetworkRestApi
+from ckanext.tracker_base import pool
 import logging
 
 logging.basicConfig()
@@ -14,6 +16,9 @@ REGEX_IDENTIFIER = re.compile('(?<=<dc:identifier>)(.+)(?=<\/dc:identifier>)')
 REGEX_NEXT_RECORD = re.compile('(?<=nextRecord=")([0-9]+)(?=")')
 GEONETWORK_METADATA_LIST = []
 
+# the GeoNetwork URL and credentials of an organization (see `ckanext.tracker_base.helpers.get_organization_geonetwork`)
+GeoNetworkOrganization = namedtuple('GeoNetworkOrganization', GEONETWORK_ORGANIZATION_FIELDS)
+
 
 def set_dict_elements(resource_dict, geonetwork_url):
     parameters = urlparse.urlparse(geonetwork_url)
@@ -26,7 +31,7 @@ def set_dict_elements(resource_dict, geonetwork_url):
 
 
 def _before_show(resource_dict, organization):
-    api = GeoNetworkRestApi(organization)
+    api = pool.get_geonetwork_api(organization)
     record = api.read_record(resource_dict['id'])
     if record is not None:
         set_dict_elements(resource_dict, organization.geonetwork_url)
@@ -37,22 +42,43 @@ def get_records_url(limit=100, offset=1):
         format(limit=limit, offset=offset)
 
 
+def get_records_page(api, offset=1):
+    """
+    Returns the identifiers of a page of records and the position of the next page (0 for the last page), raising an
+    error when the page could not be retrieved
+    """
+    data = api.get('geonetwork/srv/eng', get_records_url(offset=offset))
+    if data is None:
+        raise ValueError("GetRecords did not return any data")
+    nextRecordSearch = REGEX_NEXT_RECORD.search(data)
+    return REGEX_IDENTIFIER.findall(data), int(nextRecordSearch.group(0)) if nextRecordSearch else 0
+
+
 def get_records_and_nextrecord(api, offset=1):
-    data = None
     records = []
     nextRecord = 0
     try:
-        data = api.get('geonetwork/srv/eng', get_records_url(offset=offset))
+        records, nextRecord = get_records_page(api, offset)
     except:
         pass
         # log.debug("something went wrong with the GetRecords from {}".format(api.url))
-    if data is not None:
-        records = REGEX_IDENTIFIER.findall(data)
-        nextRecordSearch = REGEX_NEXT_RECORD.search(data)
-        nextRecord = int(nextRecordSearch.group(0))
     return records, nextRecord
 
 
+def get_all_identifiers(api):
+    """
+    Returns the identifiers of all records by paging through GetRecords, raising an error when any of the pages could
+    not be retrieved (so an incomplete set is never mistaken for the contents of the catalog)
+    """
+    identifiers = set()
+    offset = 1
+    while offset:
+        records, next_record = get_records_page(api, offset)
+        identifiers.update(records)
+        offset = next_record if next_record > offset else 0
+    return identifiers
+
+
 def geonetwork_link_is_enabled(pkg_dict):
     return link_is_enabled(pkg_dict, 'geonetwork_link_enabled')
 
@@ -1,12 +1,19 @@
+import threading
+import time
+
+from ckan import model
 import ckan.plugins.toolkit as toolkit
+import ckanext.tracker_base.helpers as base_helpers
+from ckanext.tracker_base import pool
 from ckanext.tracker_base.package_resource_tracker import PackageResourceTrackerPlugin
-from ckanext.tracker_geonetwork.helpers import geonetwork_link_is_enabled
+from ckanext.tracker_geonetwork.helpers import geonetwork_link_is_enabled, get_all_identifiers, set_dict_elements, \
+    _before_show, GeoNetworkOrganization
 from worker.geonetwork import GeoNetworkWorkerWrapper
 import ckan.plugins as plugins
 import logic.action.update as action_update
 import logic.auth.update as auth_update
 from ckanext.tracker_geoserver.interface import ITrackerGeoserver
-from ckanext.tracker_base.helpers.generic import link_is_enabled
+from ckanext.tracker_base.helpers import link_is_enabled
 import logging
 
 logging.basicConfig()
@@ -16,10 +23,12 @@ log = logging.getLogger(__name__)
 class GeonetworkTrackerPlugin(PackageResourceTrackerPlugin):
     """
     This Tracker basically does nothing tracking wise except for UI changes and the after_show for a resource to return
-    the geonetwork URL of this resource. To prevent accessing the geonetwork for every single after_show a cache can be
-    activated by setting 'local_cache_active' to True (or by using 'ckanext.{}.geonetwork.local_cache_active' in the ini).
+    the geonetwork URL of this resource. To prevent accessing the geonetwork for every single after_show this URL is only
+    added when the cache is activated by setting 'local_cache_active' to True (or by using
+    'ckanext.{}.geonetwork.local_cache_active' in the ini).
     This will then get all the identifiers from the source every 'local_cache_refresh_rate' seconds, except if the
-    requested resource has been updated since the last refresh
+    requested resource has been updated since the last refresh. The identifiers are kept per organization and refreshed
+    on a background thread, so looking up a resource never waits for GeoNetwork once the first refresh is done
     """
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IActions)
@@ -34,14 +43,26 @@ class GeonetworkTrackerPlugin(PackageResourceTrackerPlugin):
     local_cache = {}
     local_cache_last_updated = {}
     local_cache_thread_active = {}
+    local_cache_invalidated = {}
+    local_cache_lock = None
 
     DATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
+    include_package_fields = ["id", "state", "geonetwork_link_enabled"]
     exclude_resource_fields = ["wfs_url", "wms_url"]
 
     # IConfigurable
     def configure(self, config):
         super(GeonetworkTrackerPlugin, self).configure(config)
+        self.local_cache_active = toolkit.asbool(toolkit.config.get(
+            'ckanext.{}.geonetwork.local_cache_active'.format(self.name), self.local_cache_active))
+        self.local_cache_refresh_rate = int(toolkit.config.get(
+            'ckanext.{}.geonetwork.local_cache_refresh_rate'.format(self.name), self.local_cache_refresh_rate))
+        self.local_cache = {}
+        self.local_cache_last_updated = {}
+        self.local_cache_thread_active = {}
+        self.local_cache_invalidated = {}
+        self.local_cache_lock = threading.Lock()
 
     # IConfigurer
     def update_config(self, config_):
@@ -50,13 +71,142 @@ class GeonetworkTrackerPlugin(PackageResourceTrackerPlugin):
     # IActions
     def get_actions(self):
         actions = super(GeonetworkTrackerPlugin, self).get_actions()
-        actions.update({'geonetwork_callback_hook': action_update.geonetwork_callback_hook})
+        actions.update({
+            'geonetwork_callback_hook': self._geonetwork_callback_hook(),
+            'resource_show': self._resource_show_action()
+        })
         return actions
 
+    def _geonetwork_callback_hook(self):
+
+        def geonetwork_callback_hook(context, data_dict):
+            action_update.geonetwork_callback_hook(context, data_dict)
+            # our own job finished, so the identifiers know whether the record exists without asking GeoNetwork
+            self.update_local_cache(data_dict['id'], data_dict['state'] != 'deleted')
+
+        geonetwork_callback_hook.__doc__ = action_update.geonetwork_callback_hook.__doc__
+        return geonetwork_callback_hook
+
+    def _resource_show_action(self):
+
+        @toolkit.side_effect_free
+        @toolkit.chained_action
+        def _chained_action(original_action, context, data_dict):
+            result = original_action(context, data_dict)
+            try:
+                self.set_geonetwork_url(result)
+            except Exception as unexpected_error:
+                log.error("{}: could not determine the GeoNetwork URL of resource {}: {}".format(
+                    self.name, result.get('id'), unexpected_error))
+            return result
+
+        return _chained_action
+
+    # GeoNetwork identifiers *********************************************************************************
+    def get_organization(self, package_id):
+        """
+        Returns the id and the GeoNetwork URL and credentials of the organization of a package (None when the
+        organization does not have a GeoNetwork)
+        """
+        package = model.Package.get(package_id) if package_id else None
+        organization_id = package.owner_org if package is not None else None
+        context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+        organization_data = base_helpers.get_organization_geonetwork(context, organization_id)
+        if not organization_data or not organization_data.get('geonetwork_url'):
+            return None, None
+        return organization_id, GeoNetworkOrganization(**organization_data)
+
+    def set_geonetwork_url(self, resource_dict):
+        # without the identifiers in memory every resource_show would have to ask GeoNetwork
+        if not self.local_cache_active:
+            return
+        organization_id, organization = self.get_organization(resource_dict.get('package_id'))
+        if organization is None:
+            return
+        identifiers = self.get_local_cache(organization_id, organization)
+        if identifiers is not None and resource_dict['id'] not in self.local_cache_invalidated.get(organization_id, {}):
+            if resource_dict['id'] in identifiers:
+                set_dict_elements(resource_dict, organization.geonetwork_url)
+        else:
+            _before_show(resource_dict, organization)
+
+    def get_local_cache(self, organization_id, organization):
+        """
+        Returns the identifiers of the records of an organization, (re)starting the refresh when they are outdated.
+        Returns None until the first refresh is done
+        """
+        last_updated = self.local_cache_last_updated.get(organization_id)
+        if last_updated is None or time.time() - last_updated > self.local_cache_refresh_rate:
+            self.refresh_local_cache(organization_id, organization)
+        return self.local_cache.get(organization_id)
+
+    def refresh_local_cache(self, organization_id, organization):
+        with self.local_cache_lock:
+            if self.local_cache_thread_active.get(organization_id, False):
+                return
+            self.local_cache_thread_active[organization_id] = True
+        thread = threading.Thread(target=self._refresh_local_cache, args=(organization_id, organization),
+                                  name='{}-local-cache-{}'.format(self.name, organization_id))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_local_cache(self, organization_id, organization):
+        started = time.time()
+        try:
+            identifiers = get_all_identifiers(pool.get_geonetwork_api(organization))
+            with self.local_cache_lock:
+                self.local_cache[organization_id] = identifiers
+                self.local_cache_last_updated[organization_id] = started
+                invalidated = self.local_cache_invalidated.get(organization_id, {})
+                # only the resources changed while refreshing still need to be looked up
+                self.local_cache_invalidated[organization_id] = dict(
+                    (resource_id, timestamp) for resource_id, timestamp in invalidated.items() if timestamp >= started)
+            log.debug("{}: refreshed the {} GeoNetwork identifiers of organization {}".format(
+                self.name, len(identifiers), organization_id))
+        except Exception as unexpected_error:
+            # keep using the previous identifiers, the refresh is tried again after the refresh rate
+            with self.local_cache_lock:
+                self.local_cache_last_updated[organization_id] = started
+            log.error("{}: could not refresh the GeoNetwork identifiers of organization {}: {}".format(
+                self.name, organization_id, unexpected_error))
+        finally:
+            with self.local_cache_lock:
+                self.local_cache_thread_active[organization_id] = False
+
+    def invalidate_local_cache(self, resource_dict, package):
+        """
+        Makes the resource to be looked up in GeoNetwork itself until our job for it has finished
+        """
+        if self.local_cache_active and package.get('owner_org'):
+            with self.local_cache_lock:
+                self.local_cache_invalidated.setdefault(package['owner_org'], {})[resource_dict['id']] = time.time()
+
+    def update_local_cache(self, resource_id, exists):
+        if not self.local_cache_active:
+            return
+        resource = model.Resource.get(resource_id)
+        if resource is None or resource.package is None:
+            return
+        organization_id = resource.package.owner_org
+        with self.local_cache_lock:
+            identifiers = self.local_cache.get(organization_id)
+            if identifiers is not None:
+                if exists:
+                    identifiers.add(resource_id)
+                else:
+                    identifiers.discard(resource_id)
+            self.local_cache_invalidated.get(organization_id, {}).pop(resource_id, None)
+
     # IAuthFunctions
     def get_auth_functions(self):
         return {'geonetwork_callback_hook': auth_update.geonetwork_callback_hook}
 
+    def get_job_data_parts(self, entity_type, command):
+        # removing a record from GeoNetwork only requires the (credentials of the) organization
+        if command in ['delete_datasource', 'delete_package']:
+            return ['package', 'resource', 'organization']
+        return super(GeonetworkTrackerPlugin, self).get_job_data_parts(entity_type, command)
+
     # Hooks in use ****************************************************************************************
     def action_to_take_on_package_delete(self, context, package):
         if geonetwork_link_is_enabled(package):
@@ -74,14 +224,17 @@ class GeonetworkTrackerPlugin(PackageResourceTrackerPlugin):
             fields = ['wfs_url', 'wms_url']
             valid_resource = all([resource.get(field, None) for field in fields])
             if link_enabled and valid_resource:
+                self.invalidate_local_cache(resource, package)
                 return self.get_worker().create_datasource
             if not link_enabled and layer_exists:
+                self.invalidate_local_cache(resource, package)
                 return self.get_worker().delete_datasource
         return None
 
     def action_to_take_on_resource_delete(self, context, resource, package):
         layer_exists = resource.get("geonetwork_url", None)
         if layer_exists:
+            self.invalidate_local_cache(resource, package)
             return self.get_worker().delete_datasource
 
     def action_to_take_on_resource_purge(self, context, resource, package):
@@ -119,6 +272,5 @@ class GeonetworkTrackerPlugin(PackageResourceTrackerPlugin):
                 pass
 
         if command is not None:
+            self.invalidate_local_cache(resource_dict, dataset_dict)
             self.put_on_a_queue(context, 'resource', command, resource_dict, dataset_dict, None, None)
-
-        pass
@@ -1,7 +1,11 @@
 import logging
 import json
 
+import requests
+
+from ckanext.tracker_base.cache import TTLCache
 from ckanext.tracker_base.helpers import link_is_enabled
+from ckanext.tracker_geoserver.reconcile import get_feature_type_name
 from worker.geoserver.rest.model import FeatureType
 
 log = logging.getLogger(__name__)
@@ -14,6 +18,14 @@ DEFAULT_WMS_SRS = 'EPSG:4326'
 
 GEOSERVER_METADATA_LIST = ['name', 'description', 'layer_extent', 'layer_srid']
 
+FEATURE_TYPES_URL = '{url}/rest/workspaces/{workspace}/datastores/{data_store}/featuretypes.json'
+REQUEST_TIMEOUT = 30
+
+# names of the feature types per (GeoServer, workspace, data store) and, only when those can't be listed, existence per
+# feature type
+FEATURE_TYPE_INDEX_CACHE = TTLCache('geoserver_feature_type_index', maxsize=16, ttl=300)
+FEATURE_TYPE_CACHE = TTLCache('geoserver_feature_types', maxsize=4096, ttl=300)
+
 
 def geoserver_link_is_enabled(package):
     return link_is_enabled(package, 'geoserver_link_enabled')
@@ -25,10 +37,7 @@ def get_geoserver_feature_type_name(configuration, resource_dict):
     Due to XML errors in Geoserver side when layer name (resource_id string) starts with a number,
     a prefix string should be applied on the layer name. https://civity.atlassian.net/browse/DEV-3915.
     """
-    geoserver_layer_prefix = configuration.geoserver_layer_prefix
-    feature_type_name = '{prefix}{resource_id}'.format(prefix=geoserver_layer_prefix, resource_id=resource_dict['id'])
-
-    return feature_type_name
+    return get_feature_type_name(configuration, resource_dict['id'])
 
 
 def layer_extend_is_equal(origin_layer_extent_dict, remote_layer_extent_dict):
@@ -72,6 +81,70 @@ def get_geoserver_feature_type(configuration, api, workspace, data_store, resour
         return FeatureType.to_dict(feature_type)
 
 
+def _index_key(configuration, workspace, data_store):
+    return configuration.geoserver_url, workspace.name, data_store.name
+
+
+def _quote(value):
+    return requests.utils.quote(value, safe='')
+
+
+def load_geoserver_feature_type_names(configuration, api, workspace, data_store):
+    """
+    Retrieves the names of all feature types of a data store using a single GeoServer RestAPI call (reusing the session
+    of the api when it has one), returns None when they could not be listed
+    """
+    log.debug('Geoserver RestAPI call to list the feature types of {}:{}'.format(workspace.name, data_store.name))
+    url = FEATURE_TYPES_URL.format(url=(configuration.geoserver_url or '').rstrip('/'),
+                                   workspace=_quote(workspace.name), data_store=_quote(data_store.name))
+    username = getattr(configuration, 'geoserver_username', None)
+    auth = (username, getattr(configuration, 'geoserver_password', None)) if username else None
+    session = getattr(api, 'session', None) or requests
+    try:
+        response = session.get(url, auth=auth, headers={'Accept': 'application/json'}, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        # an empty data store is returned as {"featureTypes": ""}
+        feature_types = response.json().get('featureTypes') or {}
+        return set(feature_type['name'] for feature_type in feature_types.get('featureType') or [])
+    except (requests.RequestException, ValueError, AttributeError, KeyError, TypeError) as error:
+        log.error('Listing the feature types of {}:{} failed: {}'.format(workspace.name, data_store.name, error))
+        return None
+
+
+def geoserver_feature_type_exists(configuration, api, workspace, data_store, resource_dict):
+    """
+    Checks if the feature type of a resource exists using the index of the data store (see `FEATURE_TYPE_INDEX_CACHE`)
+    instead of asking GeoServer every time. When the names can't be listed the result of `get_geoserver_feature_type`
+    is cached per feature type instead
+    """
+    key = _index_key(configuration, workspace, data_store)
+    feature_type_name = get_geoserver_feature_type_name(configuration, resource_dict)
+    names = FEATURE_TYPE_INDEX_CACHE.get_or_set(
+        key, lambda: load_geoserver_feature_type_names(configuration, api, workspace, data_store))
+    if names is not None:
+        return feature_type_name in names
+    return FEATURE_TYPE_CACHE.get_or_set(
+        key + (feature_type_name,),
+        lambda: bool(get_geoserver_feature_type(configuration, api, workspace, data_store, resource_dict))
+    )
+
+
+def update_geoserver_feature_type_index(configuration, workspace, data_store, resource_dict, exists):
+    """
+    Registers a feature type which was created or deleted by one of our jobs, so the index stays correct until it is
+    refreshed
+    """
+    key = _index_key(configuration, workspace, data_store)
+    feature_type_name = get_geoserver_feature_type_name(configuration, resource_dict)
+    names = FEATURE_TYPE_INDEX_CACHE.get(key)
+    if names is not None:
+        if exists:
+            names.add(feature_type_name)
+        else:
+            names.discard(feature_type_name)
+    FEATURE_TYPE_CACHE.set(key + (feature_type_name,), exists)
+
+
 def should_publish_to_geoserver(configuration, api, workspace, data_store, package, resource):
     # todo accept resource_changes as a parameter (and take into account they don't come from the create)
     '''
@@ -2,9 +2,11 @@ import ckan.plugins.toolkit as toolkit
 from ckanext.tracker_base.package_resource_tracker import PackageResourceTrackerPlugin
 from ckanext.tracker_base.helpers import link_is_enabled
 from worker.geoserver import GeoServerWorkerWrapper
-from worker.geoserver.rest import GeoServerRestApi
+from ckanext.tracker_base import pool
 from worker.geoserver.rest.model import Workspace, DataStore
-from ckanext.tracker_geoserver.helpers import get_geoserver_feature_type
+from ckanext.tracker_geoserver.reconcile import GeoServerReconciler
+from ckanext.tracker_geoserver.helpers import geoserver_feature_type_exists, update_geoserver_feature_type_index, \
+    FEATURE_TYPE_INDEX_CACHE, FEATURE_TYPE_CACHE
 import ckan.plugins as plugins
 import logic.action.update as action_update
 import logic.auth.update as auth_update
@@ -15,6 +17,10 @@ import logging
 logging.basicConfig()
 log = logging.getLogger(__name__)
 
+# decide on create/delete in CKAN (asking GeoServer whether the layer exists) or on the worker
+DECISION_MODE_CKAN = 'ckan'
+DECISION_MODE_WORKER = 'worker'
+
 
 class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
     plugins.implements(plugins.IConfigurer)
@@ -25,10 +31,11 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
     queue_name = 'geoserver'
     worker = GeoServerWorkerWrapper()
     geoserver_link_field_name = 'geoserver_link_enabled'
-    api = None
     workspace = None
     data_store = None
+    decision_mode = DECISION_MODE_CKAN
 
+    include_package_fields = ["id", "state", "private", "geoserver_link_enabled"]
     include_resource_fields = ["id", "name", "description"]
     geoserver_mandatory_fields = ['name', 'description', 'layer_extent', 'layer_srid']
     resource_geoserver_endpoints = ['wms_url', 'wfs_url']
@@ -38,9 +45,12 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
         geoserver_url = toolkit.config.get('ckanext.{}.geoserver.url'.format(self.name), None)
         configuration = self.get_configuration()
         if geoserver_url is not None:
-            self.api = GeoServerRestApi(configuration)
             self.workspace = Workspace(name=configuration.workspace_name)
             self.data_store = DataStore(name=configuration.data_store_name)
+        feature_type_ttl = int(toolkit.config.get('ckanext.{}.feature_type_ttl'.format(self.name), 300))
+        FEATURE_TYPE_INDEX_CACHE.ttl = feature_type_ttl
+        FEATURE_TYPE_CACHE.ttl = feature_type_ttl
+        self.decision_mode = toolkit.config.get('ckanext.{}.decision_mode'.format(self.name), self.decision_mode)
 
     # IConfigurer
     def update_config(self, config_):
@@ -49,15 +59,58 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
     # IActions
     def get_actions(self):
         actions = super(GeoserverTrackerPlugin, self).get_actions()
-        actions.update({'geoserver_callback_hook': action_update.geoserver_callback_hook})
+        actions.update({'geoserver_callback_hook': self._geoserver_callback_hook()})
         return actions
 
+    def _geoserver_callback_hook(self):
+
+        def geoserver_callback_hook(context, data_dict):
+            action_update.geoserver_callback_hook(context, data_dict)
+            # our own job finished, so the index knows whether the feature type exists without asking GeoServer
+            self.update_feature_type_index({'id': data_dict['id']}, data_dict['state'] != 'deleted')
+
+        geoserver_callback_hook.__doc__ = action_update.geoserver_callback_hook.__doc__
+        return geoserver_callback_hook
+
+    def get_api(self):
+        # the clients are pooled per thread (see `ckanext.tracker_base.pool`)
+        if self.workspace is None:
+            return None
+        return pool.get_geoserver_api(self.get_configuration())
+
+    def feature_type_exists(self, resource_dict):
+        return geoserver_feature_type_exists(self.configuration, self.get_api(), self.workspace, self.data_store,
+                                             resource_dict)
+
+    def update_feature_type_index(self, resource_dict, exists):
+        if self.workspace is not None:
+            update_geoserver_feature_type_index(self.configuration, self.workspace, self.data_store, resource_dict,
+                                                exists)
+
+    def decide_on_worker(self):
+        return self.decision_mode == DECISION_MODE_WORKER
+
+    def reconcile(self, resource_dict, should_exist):
+        """
+        Returns the command letting the worker decide what to do based on the actual state of GeoServer (see
+        `ckanext.tracker_geoserver.reconcile`)
+        """
+        endpoints_exist = all([resource_dict.get(field, None) for field in self.resource_geoserver_endpoints])
+        reconciler = GeoServerReconciler(self.get_worker(), resource_dict['id'], should_exist, endpoints_exist)
+        return reconciler.reconcile_resource
+
     # IAuthFunctions
     def get_auth_functions(self):
         return {
             'geoserver_callback_hook': auth_update.geoserver_callback_hook
         }
 
+    def get_job_data_parts(self, entity_type, command):
+        # removing layers from GeoServer does not require the data dictionary, license or organization
+        if command in ['delete_datasource', 'delete_package']:
+            return ['package', 'resource']
+        return super(GeoserverTrackerPlugin, self).get_job_data_parts(entity_type, command)
+
     # ITrackerOgr
     def callback(self, context, state, resource_dict, dataset_dict):
         '''
@@ -75,12 +128,17 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
         command = None
         dataset_is_private = dataset_dict.get('private', False)
         geoserver_link_enabled = link_is_enabled(dataset_dict, 'geoserver_link_enabled')
-        geoserver_layer_exists = get_geoserver_feature_type(self.configuration,
-                                                            self.api,
-                                                            self.workspace,
-                                                            self.data_store,
-                                                            resource_dict)
         geoserver_valid_resource = all([resource_dict.get(field, None) for field in self.geoserver_mandatory_fields])
+        if self.decide_on_worker():
+            log.debug("state = {} link_enabled = {} valid_resource = {}".format(
+                state, geoserver_link_enabled, geoserver_valid_resource
+            ))
+            if geoserver_link_enabled and not dataset_is_private and state in ['created', 'updated', 'deleted']:
+                command = self.reconcile(resource_dict, state != 'deleted' and geoserver_valid_resource)
+            if command is not None:
+                self.put_on_a_queue(context, 'resource', command, resource_dict, dataset_dict, None, None)
+            return
+        geoserver_layer_exists = self.feature_type_exists(resource_dict)
         log.debug("state = {} link_enabled = {} layer_exists = {} valid_resource = {}".format(
             state, geoserver_link_enabled, geoserver_layer_exists, geoserver_valid_resource
         ))
@@ -131,11 +189,9 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
         resource_geoserver_endpoints_exist = all([resource.get(field, None) for field in self.resource_geoserver_endpoints])
         # Dataset privacy and geoserver-link changes
         if 'private' in package_changes or 'geoserver_link_enabled' in package_changes:
-            geoserver_layer_exists = get_geoserver_feature_type(self.configuration,
-                                                                self.api,
-                                                                self.workspace,
-                                                                self.data_store,
-                                                                resource)
+            if self.decide_on_worker():
+                return self.reconcile(resource, link_enabled and geoserver_valid_resource and not dataset_is_private)
+            geoserver_layer_exists = self.feature_type_exists(resource)
 
             log.info("{} :: action_to_take_on_resource_update :: privacy = {} link_enabled = {}, layer_exists = {}, valid_resource = {}".format(
                 self.name, dataset_is_private, link_enabled, geoserver_layer_exists, geoserver_valid_resource
@@ -169,11 +225,9 @@ class GeoserverTrackerPlugin(PackageResourceTrackerPlugin):
             - Package."geoserver_link_enabled" == True AND
             - Necessary resource fields that matter to Geoserver available/valid
         """
-        geoserver_layer_exists = get_geoserver_feature_type(self.configuration,
-                                                            self.api,
-                                                            self.workspace,
-                                                            self.data_store,
-                                                            resource)
+        if self.decide_on_worker():
+            return self.reconcile(resource, False)
+        geoserver_layer_exists = self.feature_type_exists(resource)
         if geoserver_layer_exists:
             return self.get_worker().delete_datasource
 
@@ -0,0 +1,60 @@
+"""
+Deciding on the worker instead of in CKAN (`ckanext.tracker_geoserver.decision_mode = worker`). Instead of asking
+GeoServer whether the feature type of a resource exists while handling a CKAN action, `GeoserverTrackerPlugin` puts a
+single `reconcile_resource` job on the queue which compares the desired state (determined in CKAN using nothing but the
+package and resource) with the actual state of GeoServer and then creates/updates, deletes or does nothing.
+
+This module is imported by the workers, so it should not depend on CKAN itself.
+"""
+import logging
+
+from domain.task_status import COMPLETE
+from worker.geoserver.rest.model import Workspace, DataStore
+
+from ckanext.tracker_base import pool
+from ckanext.tracker_base.remote import update_task
+
+log = logging.getLogger(__name__)
+
+
+def get_feature_type_name(configuration, resource_id):
+    return '{prefix}{resource_id}'.format(prefix=configuration.geoserver_layer_prefix, resource_id=resource_id)
+
+
+class GeoServerReconciler(object):
+    """
+    Picklable command carrying the desired state of the feature type of a single resource
+    """
+
+    def __init__(self, worker, resource_id, should_exist, endpoints_exist=False):
+        self.worker = worker
+        self.resource_id = resource_id
+        self.should_exist = should_exist
+        self.endpoints_exist = endpoints_exist
+
+    def feature_type_exists(self, configuration):
+        api = pool.get_geoserver_api(configuration)
+        feature_type = api.read_feature_type(Workspace(name=configuration.workspace_name),
+                                             DataStore(name=configuration.data_store_name),
+                                             get_feature_type_name(configuration, self.resource_id))
+        return bool(feature_type)
+
+    def decide(self, configuration):
+        """
+        Returns the command of the worker to run (None when GeoServer is already in the desired state)
+        """
+        if self.should_exist:
+            # creating the datasource also updates an existing one
+            return self.worker.create_datasource
+        if self.endpoints_exist or self.feature_type_exists(configuration):
+            # also removes the GeoServer endpoints from the resource metadata
+            return self.worker.delete_datasource
+        return None
+
+    def reconcile_resource(self, configuration, package, resource, data_dictionary):
+        command = self.decide(configuration)
+        if command is not None:
+            log.debug("reconciling resource {} using {}".format(self.resource_id, command.__name__))
+            return command(configuration, package, resource, data_dictionary)
+        log.debug("resource {} is already reconciled".format(self.resource_id))
+        update_task(configuration, COMPLETE, 'nothing to do')
@@ -0,0 +1,116 @@
+"""
+Streaming exports of a datastore table for `/ogr/dump/<resource_id>`. For the formats which can be written
+sequentially ogr2ogr writes to `/vsistdout/` and its output is sent to the client in chunks as it is produced, instead of
+writing the whole export to a temporary file first (see `ckanext.tracker_ogr.stream_export`). Formats which need random
+access while being written (shp/zip, gpkg) are still exported to a temporary file by the ogr worker.
+"""
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+
+from sqlalchemy.engine.url import make_url
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# format: (ogr2ogr driver, extra options)
+STREAMING_FORMATS = {
+    'geojson': ('GeoJSON', []),
+    'geojsonseq': ('GeoJSONSeq', []),
+    'csv': ('CSV', ['-lco', 'GEOMETRY=AS_WKT'])
+}
+
+# columns added by the datastore itself
+DATASTORE_COLUMNS = ['_id', '_full_text']
+
+
+class ExportError(Exception):
+    pass
+
+
+def is_streamable(file_format):
+    return file_format in STREAMING_FORMATS
+
+
+def get_connection(database_url):
+    """
+    Returns the OGR PostgreSQL connection string and the environment containing the password (so it doesn't show up in
+    the list of processes)
+    """
+    url = make_url(database_url)
+    parts = [('host', url.host), ('port', url.port), ('dbname', url.database), ('user', url.username)]
+    env = dict(os.environ)
+    if url.password:
+        env['PGPASSWORD'] = str(url.password)
+    return 'PG:' + ' '.join('{}={}'.format(key, value) for key, value in parts if value), env
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def build_command(ogr2ogr_command, connection, resource_id, columns, file_format, layer_name):
+    driver, options = STREAMING_FORMATS[file_format]
+    sql = 'SELECT {} FROM {}'.format(
+        ', '.join(_quote(column) for column in columns if column not in DATASTORE_COLUMNS) or '*', _quote(resource_id))
+    return shlex.split(ogr2ogr_command) + ['-f', driver, '/vsistdout/', connection, '-sql', sql, '-nln', layer_name] \
+        + options
+
+
+class ExportStream(object):
+    """
+    Iterable over the output of an ogr2ogr process. The WSGI server closes every response (even one which was never
+    iterated, e.g. for a HEAD request or a client which disconnected early), which kills the process when it is still
+    running and removes its error output
+    """
+
+    def __init__(self, process, errors, first, chunk_size=CHUNK_SIZE):
+        self.process = process
+        self.errors = errors
+        self.first = first
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def error_message(self):
+        self.errors.seek(0)
+        return self.errors.read().decode('utf-8', 'replace').strip()
+
+    def __iter__(self):
+        chunk = self.first
+        while chunk:
+            yield chunk
+            chunk = self.process.stdout.read(self.chunk_size)
+        if self.process.wait() != 0:
+            log.error("streaming export ended with exit code {}: {}".format(self.process.returncode,
+                                                                           self.error_message()))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+        finally:
+            self.process.stdout.close()
+            self.errors.close()
+
+
+def stream(command, env, chunk_size=CHUNK_SIZE):
+    """
+    Runs the command and returns an `ExportStream` over its output. The first chunk is read right away, so an export
+    which fails before producing anything raises an ExportError (while the response can still be changed)
+    """
+    # stderr goes to a file, a pipe nobody reads could fill up and block ogr2ogr
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors, env=env)
+    export_stream = ExportStream(process, errors, process.stdout.read(chunk_size), chunk_size)
+    if not export_stream.first and process.wait() != 0:
+        message = export_stream.error_message()
+        export_stream.close()
+        raise ExportError(message)
+    return export_stream
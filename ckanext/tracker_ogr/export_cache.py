@@ -0,0 +1,117 @@
+"""
+On disk cache of the exports generated for `/ogr/dump/<resource_id>`, so repeated downloads of the same export don't
+run ogr2ogr again. Entries are stored per resource (`{path}/{resource_id}/{key}.{extension}`) and keyed by the
+revision of the resource, the format and the spatial filter. The entries of a resource are removed when one of the jobs
+of the ogr tracker for that resource finishes (see `ogr_callback_hook`) and the least recently used entries are removed
+when the cache grows beyond its maximum size.
+
+- `ckanext.tracker_ogr.export_cache.path` (optional): directory of the cache, the cache is not used when not set
+- `ckanext.tracker_ogr.export_cache.max_size` (default: `1073741824`): maximum size of the cache in bytes
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+_eviction_lock = threading.Lock()
+
+
+class ExportCache(object):
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    @staticmethod
+    def get_revision(res_dict):
+        """
+        Returns what identifies the current contents of the datastore table of a resource
+        """
+        return '{}:{}'.format(res_dict.get('last_modified') or res_dict.get('metadata_modified'), res_dict.get('hash'))
+
+    def get_path(self, res_dict, file_format, extension, query_geometry_shape=None, query_geometry_srid=None):
+        key = '\n'.join(u'{}'.format(part or '') for part in [
+            res_dict['id'], self.get_revision(res_dict), file_format, query_geometry_shape, query_geometry_srid])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, res_dict['id'], '{}.{}'.format(digest, extension))
+
+    def get(self, path):
+        """
+        Returns the path when the export is cached (marking it as recently used), None otherwise
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, path, source_path):
+        """
+        Moves a generated export into the cache. The file is first moved next to its final location and then renamed,
+        so a partially written export is never served
+        """
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        temporary_path = os.path.join(directory, '.{}.tmp'.format(uuid.uuid4().hex))
+        shutil.move(source_path, temporary_path)
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            # leave the export where it was, so it can still be sent
+            shutil.move(temporary_path, source_path)
+            raise
+        self.evict()
+        return path
+
+    def invalidate(self, resource_id):
+        shutil.rmtree(os.path.join(self.path, resource_id), ignore_errors=True)
+
+    def _entries(self):
+        for directory, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if file_name.startswith('.'):
+                    continue
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits within its maximum size
+        """
+        if not _eviction_lock.acquire(False):
+            # another thread is already evicting
+            return
+        try:
+            entries = sorted(self._entries())
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, path in entries:
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    size -= entry_size
+                except OSError:
+                    pass
+        finally:
+            _eviction_lock.release()
+
+
+def create_cache(config, name):
+    path = config.get('ckanext.{}.export_cache.path'.format(name), None)
+    if not path:
+        return None
+    return ExportCache(path, int(config.get('ckanext.{}.export_cache.max_size'.format(name), DEFAULT_MAX_SIZE)))
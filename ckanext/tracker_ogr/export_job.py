@@ -0,0 +1,109 @@
+"""
+Asynchronous exports for `/ogr/export/<resource_id>`. Instead of running ogr2ogr while handling the request, an
+`export_resource` job is put on the queue of the ogr tracker (with a TaskStatus like any other job of that tracker). The
+worker writes the export into the export cache (see `ckanext.tracker_ogr.export_cache`, which therefore needs to be
+shared by CKAN and the workers), from where it is served by `/ogr/dump/<resource_id>` once the job is complete.
+
+The number of running exports is limited per user and in total using a sorted set per user and a global one in Redis
+(member: reservation, score: time of the reservation). Reservations are released when the job finishes and expire after
+the timeout of the jobs in case a worker dies.
+
+This module is imported by the workers, so it should not depend on CKAN itself.
+"""
+import logging
+import time
+import uuid
+
+from domain.task_status import COMPLETE, ERROR
+from rq import get_current_connection
+
+from ckanext.tracker_base.remote import update_task
+
+log = logging.getLogger(__name__)
+
+EXPORTS_KEY = 'ckanext-tracker:exports'
+USER_EXPORTS_KEY = 'ckanext-tracker:exports:{user}'
+
+
+class ExportLimitReached(Exception):
+    pass
+
+
+# prunes the expired reservations, checks both limits and adds the reservation to both sets as a single atomic step
+# KEYS: the global and the user set, ARGV: now, expired before, user limit, global limit, reservation, timeout
+RESERVE_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], 0, ARGV[2])
+redis.call('zremrangebyscore', KEYS[2], 0, ARGV[2])
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[4]) or redis.call('zcard', KEYS[2]) >= tonumber(ARGV[3]) then
+    return 0
+end
+for _, key in ipairs(KEYS) do
+    redis.call('zadd', key, ARGV[1], ARGV[5])
+    redis.call('expire', key, ARGV[6])
+end
+return 1
+"""
+
+
+def reserve(connection, user, user_limit, global_limit, timeout):
+    """
+    Reserves one of the available exports for a user, returning the reservation. Raises ExportLimitReached when the
+    user or everyone together already reached their limit
+    """
+    now = time.time()
+    reservation = uuid.uuid4().hex
+    reserved = connection.register_script(RESERVE_SCRIPT)(
+        keys=[EXPORTS_KEY, USER_EXPORTS_KEY.format(user=user)],
+        args=[now, now - timeout, user_limit, global_limit, reservation, int(timeout)])
+    if not reserved:
+        raise ExportLimitReached()
+    return reservation
+
+
+def release(connection, user, reservation):
+    pipeline = connection.pipeline()
+    pipeline.zrem(EXPORTS_KEY, reservation)
+    pipeline.zrem(USER_EXPORTS_KEY.format(user=user), reservation)
+    pipeline.execute()
+
+
+class OgrExport(object):
+    """
+    Picklable command carrying the parameters of a single export
+    """
+
+    def __init__(self, worker, cache, cache_path, resource_id, file_format, file_name, query_geometry_shape=None,
+                 query_geometry_srid=None, user=None, reservation=None):
+        self.worker = worker
+        self.cache = cache
+        self.cache_path = cache_path
+        self.resource_id = resource_id
+        self.file_format = file_format
+        self.file_name = file_name
+        self.query_geometry_shape = query_geometry_shape
+        self.query_geometry_srid = query_geometry_srid
+        self.user = user
+        self.reservation = reservation
+
+    def export_resource(self, configuration, package, resource, data_dictionary):
+        try:
+            update_task(configuration, 'running')
+            ogr_response = self.worker.create_worker().generate_ogr_file(
+                configuration=configuration,
+                resource_id=self.resource_id,
+                file_format=self.file_format,
+                file_name=self.file_name,
+                query_geometry_shape=self.query_geometry_shape,
+                query_geometry_srid=self.query_geometry_srid,
+                datadictionary=None
+            )
+            if not ogr_response.get('success', False):
+                raise RuntimeError("OGR file export failed: {}".format(ogr_response.get('message')))
+            self.cache.put(self.cache_path, ogr_response.get('path'))
+            update_task(configuration, COMPLETE)
+        except Exception as export_error:
+            log.error("exporting resource {} failed: {}".format(self.resource_id, export_error))
+            update_task(configuration, ERROR, str(export_error))
+        finally:
+            if self.reservation is not None:
+                release(get_current_connection(), self.user, self.reservation)
@@ -0,0 +1,68 @@
+"""
+Record of the last successful ingestion per resource, so an update of a resource which would load exactly the same data
+into the datastore again (e.g. re-uploading an identical file) can be skipped. A record consists of the content digest of
+the resource (its `hash`), what identifies the uploaded or linked file (`url`, `size` and `last_modified`) and the
+parameters of the ingestion and is kept in a Redis hash per tracker. An update is only skipped when all of these are the
+same. Resources without a `hash` are always ingested, as there is no way to tell whether their content changed.
+
+A skipped ingestion still goes through the queue as a `skip_resource` job (see `SkippedIngestion`), so it gets a
+TaskStatus and shows up in the history like any other job. This module is imported by the workers, so it should not
+depend on CKAN itself.
+"""
+import json
+
+from domain.task_status import COMPLETE
+
+from ckanext.tracker_base.remote import update_task
+
+INGEST_KEY = 'ckanext-tracker:ingest:{tracker}'
+
+
+def get_key(tracker_name):
+    return INGEST_KEY.format(tracker=tracker_name)
+
+
+def get_record(configuration, res_dict):
+    """
+    Returns the record describing the ingestion of the resource in its current state, None when it has no digest
+    """
+    digest = res_dict.get('hash')
+    if not digest:
+        return None
+    return json.dumps({
+        'hash': digest,
+        'url': res_dict.get('url'),
+        'size': res_dict.get('size'),
+        'last_modified': res_dict.get('last_modified'),
+        'format': (res_dict.get('format') or '').lower(),
+        'ogr2ogr': configuration.ogr2ogr_command
+    }, sort_keys=True)
+
+
+def is_ingested(connection, tracker_name, resource_id, record):
+    if record is None:
+        return False
+    stored = connection.hget(get_key(tracker_name), resource_id)
+    if isinstance(stored, bytes):
+        stored = stored.decode('utf-8')
+    return stored == record
+
+
+def remember(connection, tracker_name, resource_id, record):
+    if record is None:
+        forget(connection, tracker_name, resource_id)
+    else:
+        connection.hset(get_key(tracker_name), resource_id, record)
+
+
+def forget(connection, tracker_name, resource_id):
+    connection.hdel(get_key(tracker_name), resource_id)
+
+
+class SkippedIngestion(object):
+    """
+    Picklable command for an update of a resource whose data is identical to the last ingestion
+    """
+
+    def skip_resource(self, configuration, package, resource, data_dictionary):
+        update_task(configuration, COMPLETE, 'skipped: the data is identical to the last ingestion')
@@ -7,6 +7,12 @@ from ckanext.tracker_base.package_resource_tracker import PackageResourceTracker
 from worker.ogr import OgrWorkerWrapper
 import logging
 import ckanext.tracker_ogr.views as views
+from ckanext.tracker_ogr.export_cache import create_cache
+from ckanext.tracker_ogr import export_job, ingest
+from ckanext.tracker_base.base_tracker import submit_jobs
+from ckanext.tracker_base.model import PlannedJob
+from ckanext.tracker_ogr.interface import ITrackerOgr
+from domain.task_status import ERROR
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -24,6 +30,7 @@ class OgrTrackerPlugin(PackageResourceTrackerPlugin):
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(ITrackerOgr)
 
     queue_name = 'ogr'
     worker = OgrWorkerWrapper()
@@ -34,12 +41,154 @@ class OgrTrackerPlugin(PackageResourceTrackerPlugin):
 
     include_resource_fields = ['url', 'size', 'hash', 'format']
 
+    stream_export = False  # type: bool
+    export_cache = None  # type: ExportCache
+    export_user_limit = 2  # type: int
+    export_global_limit = 10  # type: int
+    prerender_formats = []  # type: list
+    prerender_formats_field = 'ogr_prerender_formats'
+    skip_identical_ingestion = False  # type: bool
+
+    # IConfigurable
+    def configure(self, config):
+        super(OgrTrackerPlugin, self).configure(config)
+        self.stream_export = toolkit.asbool(toolkit.config.get('ckanext.{}.stream_export'.format(self.name),
+                                                               self.stream_export))
+        self.export_cache = create_cache(toolkit.config, self.name)
+        self.export_user_limit = int(toolkit.config.get('ckanext.{}.export_limit.user'.format(self.name),
+                                                        self.export_user_limit))
+        self.export_global_limit = int(toolkit.config.get('ckanext.{}.export_limit.global'.format(self.name),
+                                                          self.export_global_limit))
+        self.skip_identical_ingestion = toolkit.asbool(toolkit.config.get(
+            'ckanext.{}.skip_identical_ingestion'.format(self.name), self.skip_identical_ingestion))
+        self.prerender_formats = toolkit.aslist(toolkit.config.get('ckanext.{}.prerender_formats'.format(self.name),
+                                                                   self.prerender_formats))
+
+    def get_stream_export(self):
+        return self.stream_export
+
+    def get_export_cache(self):
+        return self.export_cache
+
+    def submit_export(self, context, res_dict, pkg_dict, cache_path, file_format, file_name, query_geometry_shape,
+                      query_geometry_srid, user):
+        """
+        Puts an export job on the queue (see `ckanext.tracker_ogr.export_job`) and returns its TaskStatus. Raises
+        ExportLimitReached when the user or everyone together already reached the limit of running exports
+        """
+        connection = self.get_connection()
+        reservation = export_job.reserve(connection, user, self.export_user_limit, self.export_global_limit,
+                                         int(self.get_configuration().redis_job_timeout or 180))
+        export = export_job.OgrExport(self.get_worker(), self.export_cache, cache_path, res_dict['id'], file_format,
+                                      file_name, query_geometry_shape, query_geometry_srid, user, reservation)
+        planned_job = self._plan_export(context, export, res_dict, pkg_dict)
+        submit_jobs(context, [planned_job])
+        if planned_job.task is None or planned_job.task.state == ERROR:
+            export_job.release(connection, user, reservation)
+        return planned_job.task
+
+    def _plan_export(self, context, export, res_dict, pkg_dict):
+        # every export is a job on its own, so they are never coalesced
+        return PlannedJob(self, 'resource', export.export_resource, res_dict, pkg_dict,
+                          compact=not context.get('tracker_full_payload', False), coalesce=False)
+
+    def get_prerender_formats(self, pkg_dict):
+        """
+        Returns the export formats to generate once a resource of the package is in the datastore, which can be
+        overridden per package using the `ogr_prerender_formats` field (an empty value disabling it for that package)
+        """
+        formats = pkg_dict.get(self.prerender_formats_field, None)
+        if formats is None:
+            return self.prerender_formats
+        return toolkit.aslist(formats.replace(',', ' '))
+
+    def prerender_exports(self, context, res_dict, pkg_dict):
+        """
+        Puts an export job on the queue for every format to pre-render (see `get_prerender_formats`) which isn't in
+        the export cache yet, so the first download of those formats is served from the cache
+        """
+        if self.export_cache is None:
+            return
+        supported_formats = self.get_worker().create_worker().DEFAULT_SUPPORTED_FORMATS
+        file_name = views._get_name_from_url(res_dict.get('url'))
+        planned_jobs = []
+        for file_format in self.get_prerender_formats(pkg_dict):
+            file_format = file_format.lower()
+            if file_format not in supported_formats:
+                log.warning("{}: can't pre-render unsupported format {}".format(self.name, file_format))
+                continue
+            cache_path = self.export_cache.get_path(res_dict, file_format, views._get_download_format(file_format))
+            if self.export_cache.get(cache_path) is not None:
+                continue
+            export = export_job.OgrExport(self.get_worker(), self.export_cache, cache_path, res_dict['id'],
+                                          file_format, file_name)
+            planned_jobs.append(self._plan_export(context, export, res_dict, pkg_dict))
+        if planned_jobs:
+            submit_jobs(context, planned_jobs)
+
+    # ITrackerOgr
+    def callback(self, context, state, resource_dict, dataset_dict):
+        """
+        Once a resource has been loaded into the datastore the configured export formats are pre-rendered
+        """
+        if state in ['created', 'updated']:
+            self.remember_ingestion(resource_dict)
+            self.prerender_exports(context, resource_dict, dataset_dict)
+        elif state == 'deleted':
+            self.forget_ingestion(resource_dict)
+
+    # Ingestion records (see `ckanext.tracker_ogr.ingest`)
+    def is_ingested(self, res_dict):
+        """
+        Returns True when the data of the resource is byte-identical to the last successful ingestion, using the same
+        parameters, and is still in the datastore
+        """
+        if not self.skip_identical_ingestion or not res_dict.get('datastore_active', False):
+            return False
+        try:
+            return ingest.is_ingested(self.get_connection(), self.name, res_dict['id'],
+                                      ingest.get_record(self.get_configuration(), res_dict))
+        except Exception as unexpected_error:
+            log.error("{}: could not read the ingestion record of {}: {}".format(
+                self.name, res_dict['id'], unexpected_error))
+            return False
+
+    def remember_ingestion(self, res_dict):
+        if not self.skip_identical_ingestion:
+            return
+        try:
+            ingest.remember(self.get_connection(), self.name, res_dict['id'],
+                            ingest.get_record(self.get_configuration(), res_dict))
+        except Exception as unexpected_error:
+            log.error("{}: could not store the ingestion record of {}: {}".format(
+                self.name, res_dict['id'], unexpected_error))
+
+    def forget_ingestion(self, res_dict):
+        if not self.skip_identical_ingestion:
+            return
+        try:
+            ingest.forget(self.get_connection(), self.name, res_dict['id'])
+        except Exception as unexpected_error:
+            log.error("{}: could not remove the ingestion record of {}: {}".format(
+                self.name, res_dict['id'], unexpected_error))
+
     # IActions
     def get_actions(self):
         actions = super(OgrTrackerPlugin, self).get_actions()
-        actions.update({'ogr_callback_hook': action_update.ogr_callback_hook})
+        actions.update({'ogr_callback_hook': self._ogr_callback_hook()})
         return actions
 
+    def _ogr_callback_hook(self):
+
+        def ogr_callback_hook(context, data_dict):
+            # the datastore table was (re)created or dropped, so the cached exports are outdated
+            if self.export_cache is not None:
+                self.export_cache.invalidate(data_dict['id'])
+            action_update.ogr_callback_hook(context, data_dict)
+
+        ogr_callback_hook.__doc__ = action_update.ogr_callback_hook.__doc__
+        return ogr_callback_hook
+
     # IAuthFunctions
     def get_auth_functions(self):
         return {
@@ -55,20 +204,34 @@ class OgrTrackerPlugin(PackageResourceTrackerPlugin):
         u'''Return a Flask Blueprint object to be registered by the app.'''
         return views.create_blueprint(self)
 
+    def get_job_data_parts(self, entity_type, command):
+        # dropping the datastore table does not require the data dictionary, license or organization
+        if command == 'delete_resource':
+            return ['package', 'resource']
+        # an export only needs the resource (see `ckanext.tracker_ogr.export_job`), neither does a skipped ingestion
+        if command in ['export_resource', 'skip_resource']:
+            return ['resource']
+        return super(OgrTrackerPlugin, self).get_job_data_parts(entity_type, command)
+
+    def get_data_context(self, context):
+        # the datastore of the resource is read as the automation user, not as the user performing the action
+        return {'model': model, 'ignore_auth': True, 'defer_commit': True, 'user': 'automation'}
+
     #  Return the action for each Hook - Default to None ***********************************
     def action_to_take_on_resource_create(self, context, res_dict, pkg_dict):
-        context = {'model': model, 'ignore_auth': True, 'defer_commit': True, 'user': 'automation'}
-        return self.put_on_a_queue(context, 'resource',
-                                   self.get_worker().create_resource, res_dict, pkg_dict, None, None)
+        return self.get_worker().create_resource
 
     def action_to_take_on_resource_update(self, context, res_dict, resource_changes, pkg_dict, package_changes):
+        if self.is_ingested(res_dict):
+            log.debug("{}: skipping the ingestion of {}, the data did not change".format(self.name, res_dict['id']))
+            return ingest.SkippedIngestion().skip_resource
         return self.action_to_take_on_resource_create(context, res_dict, pkg_dict)
 
     def action_to_take_on_resource_delete(self, context, res_dict, pkg_dict):
         if res_dict.get("datastore_active", False):
-            context = {'model': model, 'ignore_auth': True, 'defer_commit': True, 'user': 'automation'}
-            return self.put_on_a_queue(context, 'resource',
-                                       self.get_worker().delete_resource, res_dict, pkg_dict, None, None)
+            self.forget_ingestion(res_dict)
+            return self.get_worker().delete_resource
+        return None
 
     def action_to_take_on_resource_purge(self, context, res_dict, pkg_dict):
         return self.action_to_take_on_resource_delete(context, res_dict, pkg_dict)
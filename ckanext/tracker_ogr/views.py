@@ -7,6 +7,9 @@ from ckan import model
 import os
 from ckan.plugins import toolkit
 import mimetypes
+from ckanext.tracker_ogr import export
+from ckanext.tracker_ogr.export_job import ExportLimitReached
+from domain.task_status import COMPLETE, ERROR, DomainTaskStatus
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -50,6 +53,71 @@ def _get_res_dict(id):
     return res_dict
 
 
+def _get_export_parameters(ogr_worker):
+    """
+    Returns the (validated) format, spatial filter and srid of an export
+    """
+    file_format = toolkit.request.args.get('format', None)
+    query_geometry_shape = toolkit.request.args.get('queryGeometry', None)  # Not easy to verify the WKB value validity.
+    query_geometry_srid = toolkit.request.args.get('srid', None)  # Must correspond a positive integer
+    if not file_format:
+        toolkit.abort(404, toolkit._('This endpoint requires a format parameter.'))
+    file_format = file_format.lower()
+    if file_format not in ogr_worker.DEFAULT_SUPPORTED_FORMATS:
+        toolkit.abort(404, toolkit._('"{}" is not OGR supported. Supported filetypes are: {} ').format(file_format, ", ".join(ogr_worker.DEFAULT_SUPPORTED_FORMATS)))
+    if (query_geometry_shape and not query_geometry_srid) or (not query_geometry_shape and query_geometry_srid):
+        toolkit.abort(404, toolkit._('When applying a spatial filter to OGR download, both "query_geometry_shape" and "query_geometry_srid" parameters must be defined with a proper value.'))
+    if query_geometry_srid and not query_geometry_srid.isdigit():
+        toolkit.abort(404, toolkit._('The geometry srid defined ("{}") is invalid.'.format(query_geometry_srid)))
+    return file_format, query_geometry_shape, query_geometry_srid
+
+
+def _get_export_url(endpoint, resource_id, file_format, query_geometry_shape=None, query_geometry_srid=None, **kwargs):
+    parameters = {'format': file_format, 'queryGeometry': query_geometry_shape, 'srid': query_geometry_srid}
+    kwargs.update((key, value) for key, value in parameters.items() if value)
+    return toolkit.url_for(endpoint, resource_id=resource_id, **kwargs)
+
+
+def _get_download_format(file_format):
+    # map .shp extension into .zip extension
+    if file_format == 'shp':
+        return 'zip'
+    return file_format
+
+
+def _set_download_headers(response, resource_id, file_name, download_format):
+    content_type, content_enc = mimetypes.guess_type("/{}.{}".format(resource_id, download_format))
+    if content_type:
+        response.headers['Content-Type'] = content_type
+    # assign content-disposition to headers to include resource name and proper extension
+    response.headers['Content-Disposition'] = 'attachment; filename={resource_name}.{extension}'.format(
+        resource_name=file_name,
+        extension=download_format)
+    return response
+
+
+def _stream_ogr_file(ogr_tracker_plugin, resource_id, file_format, file_name):
+    """
+    Streams the output of ogr2ogr to the client (see `ckanext.tracker_ogr.export`)
+    """
+    configuration = ogr_tracker_plugin.get_configuration()
+    try:
+        fields = toolkit.get_action('datastore_search')(_get_context(), {'id': resource_id, 'limit': 0}).get('fields')
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+        toolkit.abort(404, toolkit._('Resource not found'))
+    connection, env = export.get_connection(toolkit.config.get('ckan.datastore.read_url') or configuration.database_url)
+    command = export.build_command(configuration.ogr2ogr_command, connection, resource_id,
+                                   [field['id'] for field in fields or []], file_format, file_name)
+    try:
+        chunks = export.stream(command, env)
+    except export.ExportError as export_error:
+        log.error("Streaming OGR export of {} failed: {}".format(resource_id, export_error))
+        toolkit.abort(404, toolkit._('OGR file export failed.'))
+    # the response closes the stream once it is done with it (see `ExportStream`)
+    response = flask.Response(chunks)
+    return _set_download_headers(response, resource_id, file_name, file_format)
+
+
 def resource_tracker_ogr_view(ogr_tracker_plugin):
     class ResourceTrackerOgrView(MethodView):
 
@@ -84,25 +152,24 @@ def dump_tracker_ogr_view(ogr_tracker_plugin):
         def get(self, resource_id):
             res_dict = _get_res_dict(resource_id)
             ogr_worker = self.ogr.get_worker().create_worker()
-
-            file_format = toolkit.request.args.get('format', None)
-            query_geometry_shape = toolkit.request.args.get('queryGeometry', None)  # Not easy to verify the WKB value validity.
-            query_geometry_srid = toolkit.request.args.get('srid', None)  # Must correspond a positive integer
-            if not file_format:
-                toolkit.abort(404, toolkit._('This endpoint requires a format parameter.'))
-            file_format = file_format.lower()
-            if file_format not in ogr_worker.DEFAULT_SUPPORTED_FORMATS:
-                toolkit.abort(404, toolkit._('"{}" is not OGR supported. Supported filetypes are: {} ').format(file_format, ", ".join(ogr_worker.DEFAULT_SUPPORTED_FORMATS)))
-            if (query_geometry_shape and not query_geometry_srid) or (not query_geometry_shape and query_geometry_srid):
-                toolkit.abort(404, toolkit._('When applying a spatial filter to OGR download, both "query_geometry_shape" and "query_geometry_srid" parameters must be defined with a proper value.'))
-            if query_geometry_srid and not query_geometry_srid.isdigit():
-                toolkit.abort(404, toolkit._('The geometry srid defined ("{}") is invalid.'.format(query_geometry_srid)))
+            file_format, query_geometry_shape, query_geometry_srid = _get_export_parameters(ogr_worker)
 
             # Export OGR file and store temporarily
-            worker_name = 'ogr'
-            self.ogr.get_configuration()
             # Replace resource metadata 'name' value with original filestore name, to be used for populating the new OGR generated resource.
             file_name = _get_name_from_url(res_dict.get('url'))
+            download_format = _get_download_format(file_format)
+            # Serve a previously generated export of the same revision, format and spatial filter
+            export_cache = self.ogr.get_export_cache()
+            cache_path = None
+            if export_cache is not None:
+                cache_path = export_cache.get_path(res_dict, file_format, download_format, query_geometry_shape,
+                                                   query_geometry_srid)
+                if export_cache.get(cache_path) is not None:
+                    return _set_download_headers(flask.send_file(cache_path, conditional=True), resource_id, file_name,
+                                                 download_format)
+            # the spatial filter is only applied by the ogr worker
+            if self.ogr.get_stream_export() and export.is_streamable(file_format) and not query_geometry_shape:
+                return _stream_ogr_file(self.ogr, resource_id, file_format, file_name)
             ogr_response = ogr_worker.generate_ogr_file(
                 configuration=self.ogr.get_configuration(),
                 resource_id=resource_id,
@@ -112,23 +179,17 @@ def dump_tracker_ogr_view(ogr_tracker_plugin):
                 query_geometry_srid=query_geometry_srid,
                 datadictionary=None
             )
-            # map .shp extension into .zip extension
-            if file_format == 'shp':
-                download_format = 'zip'
-            else:
-                download_format = file_format
             # Fulfill request, download OGR file
             if ogr_response.get("success", False):
                 filepath = ogr_response.get('path')
-                response = flask.send_file(filepath)
-                content_type, content_enc = mimetypes.guess_type("/{}.{}".format(resource_id, download_format))
-                if content_type:
-                    response.headers['Content-Type'] = content_type
-                # assign content-disposition to headers to include resource name and proper extension
-
-                response.headers['Content-Disposition'] = 'attachment; filename={resource_name}.{extension}'.format(
-                    resource_name=file_name,
-                    extension=download_format)
+                if cache_path is not None:
+                    try:
+                        export_cache.put(cache_path, filepath)
+                        return _set_download_headers(flask.send_file(cache_path, conditional=True), resource_id,
+                                                     file_name, download_format)
+                    except (IOError, OSError) as cache_error:
+                        log.error("Could not cache the OGR export of {}: {}".format(resource_id, cache_error))
+                response = _set_download_headers(flask.send_file(filepath), resource_id, file_name, download_format)
                 # Delete temporary OGR file
                 ogr_worker.delete_ogr_file(filepath)
                 return response
@@ -138,8 +199,89 @@ def dump_tracker_ogr_view(ogr_tracker_plugin):
     return DumpTrackerOgrView
 
 
+def export_tracker_ogr_view(ogr_tracker_plugin):
+
+    class ExportTrackerOgrView(MethodView):
+        """
+        Asynchronous exports (see `ckanext.tracker_ogr.export_job`): a POST puts an export job on the queue and
+        returns the URL to poll its state and the URL to download it from once it is complete
+        """
+
+        ogr = ogr_tracker_plugin
+
+        def post(self, resource_id):
+            res_dict = _get_res_dict(resource_id)
+            export_cache = self.ogr.get_export_cache()
+            if export_cache is None:
+                toolkit.abort(404, toolkit._('Asynchronous OGR exports are not enabled.'))
+            ogr_worker = self.ogr.get_worker().create_worker()
+            file_format, query_geometry_shape, query_geometry_srid = _get_export_parameters(ogr_worker)
+            file_name = _get_name_from_url(res_dict.get('url'))
+            download_format = _get_download_format(file_format)
+            cache_path = export_cache.get_path(res_dict, file_format, download_format, query_geometry_shape,
+                                               query_geometry_srid)
+            download_url = _get_export_url(u'tracker_ogr.dump', resource_id, file_format, query_geometry_shape,
+                                           query_geometry_srid)
+            if export_cache.get(cache_path) is not None:
+                return flask.jsonify({'state': COMPLETE, 'download_url': download_url})
+
+            context = {'model': model, 'ignore_auth': True, 'defer_commit': True, 'user': 'automation'}
+            user = toolkit.g.user or toolkit.request.remote_addr
+            try:
+                task = self.ogr.submit_export(context, res_dict, _get_pkg_dict(res_dict['package_id']), cache_path,
+                                              file_format, file_name, query_geometry_shape, query_geometry_srid, user)
+            except ExportLimitReached:
+                toolkit.abort(429, toolkit._('Too many OGR exports are running, please try again later.'))
+            if task is None or task.state == ERROR:
+                toolkit.abort(404, toolkit._('OGR file export failed.'))
+            response = flask.jsonify({
+                'id': task.id,
+                'state': task.state,
+                # the status URL carries the parameters of the export, so it can refer to the download once complete
+                'status_url': _get_export_url(u'tracker_ogr.export_status', resource_id, file_format,
+                                              query_geometry_shape, query_geometry_srid, task_id=task.id),
+                'download_url': download_url
+            })
+            response.status_code = 202
+            return response
+
+        def get(self, resource_id, task_id):
+            _get_res_dict(resource_id)
+            task_dict = None
+            try:
+                task_dict = toolkit.get_action('task_status_show')({'model': model, 'ignore_auth': True},
+                                                                    {'id': task_id})
+            except toolkit.ObjectNotFound:
+                pass
+            if not task_dict or task_dict.get('entity_id') != resource_id or \
+                    task_dict.get('task_type') != self.ogr.name:
+                toolkit.abort(404, toolkit._('Export not found'))
+            task = DomainTaskStatus.from_dict(task_dict)
+            result = {
+                'id': task.id,
+                'state': task.state,
+                'error': task.error,
+                'last_updated': task_dict.get('last_updated'),
+                # when the export was put on the queue, picked up by a worker and finished
+                'progress': {state: getattr(task, state, None) for state in ['created', 'pending', 'running',
+                                                                             'complete']}
+            }
+            file_format = toolkit.request.args.get('format', None)
+            if task.state == COMPLETE and file_format:
+                result['download_url'] = _get_export_url(u'tracker_ogr.dump', resource_id, file_format,
+                                                         toolkit.request.args.get('queryGeometry', None),
+                                                         toolkit.request.args.get('srid', None))
+            return flask.jsonify(result)
+
+    return ExportTrackerOgrView
+
+
 def create_blueprint(ogr_tracker_plugin):
     blueprint = Blueprint('tracker_ogr', __name__)
     blueprint.add_url_rule(u'/dataset/<id>/resource_data/<resource_id>', view_func=resource_tracker_ogr_view(ogr_tracker_plugin).as_view(str(u'resource')))
     blueprint.add_url_rule(u'/ogr/dump/<resource_id>', view_func=dump_tracker_ogr_view(ogr_tracker_plugin).as_view(str(u'dump')))
+    export_view = export_tracker_ogr_view(ogr_tracker_plugin).as_view(str(u'export'))
+    blueprint.add_url_rule(u'/ogr/export/<resource_id>', view_func=export_view, methods=[u'POST'])
+    blueprint.add_url_rule(u'/ogr/export/<resource_id>/<task_id>', view_func=export_view, methods=[u'GET'],
+                           endpoint=u'export_status')
     return blueprint